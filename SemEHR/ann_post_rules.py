@@ -1,13 +1,22 @@
 import logging
 from os.path import join
 import re
+try:
+    import re._parser as sre_parse
+except ImportError:
+    # python < 3.11
+    import sre_parse
 import SemEHR.utils as utils
-import functools # for cmp_to_key
 
 logger = logging.getLogger(__name__)
 
 _text_window = 150
 _head_text_window_size = 200
+_min_literal_len = 2
+_dotless_i = '\u0131'
+_dotted_capital_i = '\u0130'
+_group_ref_ptn = re.compile(r'\\\d|\(\?P=|\(\?\(')
+_relocate_window = 100
 
 
 class Rule(object):
@@ -18,6 +27,7 @@ class Rule(object):
         self._is_case_sensitive = case_sensitive
         self._reg_ptns = []
         self._more_context_sents = more_context_sents
+        self._literals = None
 
     @property
     def name(self):
@@ -43,6 +53,16 @@ class Rule(object):
     def reg_patterns(self):
         return self._reg_ptns
 
+    @property
+    def literals(self):
+        """
+        the required literals of each pattern (see pattern_literals), worked out once per rule
+        """
+        if self._literals is None:
+            self._literals = [] if self.compare_type == -100 else \
+                [pattern_literals(reg_p, self.is_case_sensitive) for reg_p in self._reg_ptns]
+        return self._literals
+
     def add_pattern(self, ptn):
         if self.compare_type == -100:
             pass
@@ -58,18 +78,249 @@ class Rule(object):
             else:
                 reg_p = re.compile(ptn, re.IGNORECASE)
             self._reg_ptns.append(reg_p)
+            self._literals = None
         except Exception:
             logger.error('regs error: [%s]' % ptn)
             exit(1)
 
 
+def _flatten_sub_pattern(sub_pattern):
+    # groups without inline flags are just part of the sequence
+    for op, av in sub_pattern:
+        if op is sre_parse.SUBPATTERN and av[1] == 0 and av[2] == 0:
+            for item in _flatten_sub_pattern(av[3]):
+                yield item
+        else:
+            yield op, av
+
+
+def _better_literals(lits1, lits2):
+    if lits1 is None:
+        return lits2
+    if lits2 is None:
+        return lits1
+    k1 = (min(len(l) for l in lits1), -len(lits1))
+    k2 = (min(len(l) for l in lits2), -len(lits2))
+    return lits2 if k2 > k1 else lits1
+
+
+def _required_literals(sub_pattern, ignore_case):
+    """
+    find literals of which at least one has to occur in any string matched by a parsed pattern
+    :param sub_pattern: parsed pattern
+    :param ignore_case: only ASCII literals are used for case insensitive patterns
+    :return: a frozenset of literals or None
+    """
+    best = None
+    run = ''
+    for op, av in _flatten_sub_pattern(sub_pattern):
+        if op is sre_parse.LITERAL and (not ignore_case or av < 128):
+            run += chr(av)
+            best = _better_literals(best, frozenset([run]))
+            continue
+        run = ''
+        lits = None
+        if op is sre_parse.BRANCH:
+            alts = [_required_literals(alt, ignore_case) for alt in av[1]]
+            if None not in alts:
+                lits = frozenset().union(*alts)
+        elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT) and av[0] >= 1:
+            lits = _required_literals(av[2], ignore_case)
+        best = _better_literals(best, lits)
+    return best
+
+
+def fold_text(text):
+    """
+    case fold a text for case insensitive literal checks; python regex ignorecase
+    matching also treats the dotless i and the dotted capital I (which casefold expands) as i
+    """
+    if _dotted_capital_i in text:
+        text = text.replace(_dotted_capital_i, 'i')
+    folded = text.casefold()
+    if _dotless_i in folded:
+        folded = folded.replace(_dotless_i, 'i')
+    return folded
+
+
+def pattern_literals(reg_p, case_sensitive):
+    """
+    the literals of which at least one occurs in any string matched by a compiled rule pattern
+    :param reg_p: compiled pattern
+    :param case_sensitive: whether the pattern's rule is case sensitive, literals are case folded if not
+    :return: a frozenset of literals or None if the pattern has no (long enough) required literals
+    """
+    lits = None
+    # inline flags could make a pattern case insensitive in a case sensitive rule
+    if case_sensitive == (reg_p.flags & re.IGNORECASE == 0):
+        try:
+            lits = _required_literals(sre_parse.parse(reg_p.pattern, reg_p.flags), not case_sensitive)
+        except Exception:
+            logger.debug('failed to get literals from %s' % reg_p.pattern)
+    if lits is None or min(len(l) for l in lits) < _min_literal_len:
+        return None
+    return lits if case_sensitive else frozenset(l.casefold() for l in lits)
+
+
+def _literal_could_occur(lit, text):
+    """
+    whether a literal could occur in a context built from a text, contexts join sentences
+    (sometimes with a space in between) so a literal could span such a joint
+    """
+    if lit in text:
+        return True
+    for i in range(1, len(lit)):
+        a = lit[:i]
+        b = lit[i:]
+        if a in text and (b in text or (b.startswith(' ') and (b == ' ' or b[1:] in text))):
+            return True
+    return False
+
+
+class CompiledRuleGroup(object):
+    """
+    filter rules sharing the same compare type, case sensitivity and extra context sentences.
+    Each pattern is compiled into a set of literals (at least one of which has to occur in a
+    matching text); the literals of the whole group are checked once per text and only the
+    patterns whose literals are present are matched.
+    """
+
+    def __init__(self, compare_type, case_sensitive, more_context_sents):
+        self._compare_type = compare_type
+        self._is_case_sensitive = case_sensitive
+        self._more_context_sents = more_context_sents
+        self._rules = []
+        self._patterns = []
+        self._literals = []
+        self._lit_to_patterns = {}
+        self._unfiltered = set()
+
+    @property
+    def compare_type(self):
+        return self._compare_type
+
+    @property
+    def more_context_sents(self):
+        return self._more_context_sents
+
+    def add_rule(self, rule_idx, rule):
+        self._rules.append((rule_idx, rule))
+
+    def compile(self):
+        self._patterns = []
+        self._lit_to_patterns = {}
+        self._unfiltered = set()
+        for idx, r in self._rules:
+            for reg_p, lits in zip(r.reg_patterns, r.literals):
+                p_idx = len(self._patterns)
+                self._patterns.append((idx, r.name, reg_p))
+                if lits is None:
+                    self._unfiltered.add(p_idx)
+                    continue
+                for l in lits:
+                    self._lit_to_patterns.setdefault(l, []).append(p_idx)
+        self._literals = sorted(self._lit_to_patterns)
+
+    def match(self, s_compare):
+        """
+        match the rules of this group
+        :param s_compare:
+        :return: a list of (rule index, rule name, matched string) tuples
+        """
+        results = []
+        s_check = s_compare if self._is_case_sensitive else fold_text(s_compare)
+        candidates = set(self._unfiltered)
+        for l in self._literals:
+            if l in s_check:
+                candidates.update(self._lit_to_patterns[l])
+        matched_idx = None
+        # patterns are stored in rule order, the first matched pattern of a rule wins
+        for p_idx in sorted(candidates):
+            idx, name, reg_p = self._patterns[p_idx]
+            if idx == matched_idx:
+                continue
+            m = reg_p.match(s_compare)
+            if m is not None:
+                matched_idx = idx
+                results.append((idx, name, m.group(0)))
+                logger.debug('%s matched %s' % (s_compare, reg_p.pattern))
+        return results
+
+
+class AnnotationRelocator(object):
+    """
+    relocate annotations whose offsets drifted from the full text (e.g., because of encoding issues)
+    to the closest case insensitive whole word occurrence of their strings. one instance per document:
+    it caches the escaped patterns and remembers the last offset shift so that later annotations are
+    searched for where they are expected to be
+    """
+    def __init__(self, text, window=_relocate_window):
+        self._text = text
+        self._window = window
+        self._patterns = {}
+        self._delta = 0
+
+    @property
+    def delta(self):
+        return self._delta
+
+    def _is_boundary(self, pos):
+        # the same as \b, i.e., a word character on one side only
+        t = self._text
+        before = pos > 0 and (t[pos - 1].isalnum() or t[pos - 1] == '_')
+        after = pos < len(t) and (t[pos].isalnum() or t[pos] == '_')
+        return before != after
+
+    def relocate(self, s, e, string_orig):
+        """
+        search around the expected position and widen the window until a match is found
+        :param s: annotation start
+        :param e: annotation end
+        :param string_orig: the annotation string
+        :return: [start, end], the original offsets if the string is not found
+        """
+        t = self._text
+        if t[s:e] == string_orig:
+            return [s, e]
+        if string_orig not in self._patterns:
+            self._patterns[string_orig] = re.compile(re.escape(string_orig), re.IGNORECASE)
+        ptn = self._patterns[string_orig]
+        expected = s + self._delta
+        radius = self._window
+        best = None
+        while best is None:
+            lo = max(0, expected - radius)
+            hi = min(len(t), expected + radius + len(string_orig))
+            m = ptn.search(t, lo, hi)
+            while m is not None:
+                if self._is_boundary(m.start()) and self._is_boundary(m.end()):
+                    dis = abs(expected - m.start())
+                    if best is None or dis < best[0]:
+                        best = (dis, m.start(), m.end())
+                m = ptn.search(t, m.start() + 1, hi)
+            if best is None and lo == 0 and hi == len(t):
+                return [s, e]
+            radius *= 4
+        self._delta = best[1] - s
+        return [best[1], best[2]]
+
+
 class AnnRuleExecutor(object):
 
-    def __init__(self):
+    def __init__(self, compiled=True):
         self._text_window = _text_window
         self._filter_rules = []
         self._skip_terms = []
+        self._skip_term_index = {}
         self._osf_rules = []
+        self._osf_regs = []
+        self._osf_merged = None
+        self._osf_group_to_rule = {}
+        self._compiled = compiled
+        self._rule_groups = None
+        self._cut_off_rules = None
+        self._rule_fingerprints = {}
+        self._record_rule_fingerprints = False
 
     @property
     def skip_terms(self):
@@ -78,6 +329,26 @@ class AnnRuleExecutor(object):
     @skip_terms.setter
     def skip_terms(self, value):
         self._skip_terms = value
+        # normalise once, the first term wins if several only differ in case
+        self._skip_term_index = {}
+        for st in value:
+            self._skip_term_index.setdefault(st.lower(), st)
+
+    def match_skip_term(self, string_orig):
+        """
+        look up the (case insensitive) skip term of an annotation string
+        :param string_orig:
+        :return: the skip term or None
+        """
+        return self._skip_term_index.get(string_orig.lower())
+
+    @property
+    def compiled(self):
+        return self._compiled
+
+    @compiled.setter
+    def compiled(self, value):
+        self._compiled = value
 
     def add_filter_rule(self, token_offset, reg_strs, case_sensitive=False, rule_name='unnamed',
                         containing_pattern=False, more_context_sents=[]):
@@ -87,22 +358,36 @@ class AnnRuleExecutor(object):
         for p in reg_strs:
             rule.add_pattern(p)
         self._filter_rules.append(rule)
+        self._rule_groups = None
+
+    def compile_rules(self):
+        """
+        group the filter rules by compare type, case sensitivity and extra context sentences
+        so that each group can be prefiltered by the literals of its patterns
+        :return:
+        """
+        groups = {}
+        rule_groups = []
+        cut_off_rules = []
+        for idx, r in enumerate(self._filter_rules):
+            if r.compare_type == -100:
+                cut_off_rules.append((idx, r))
+                continue
+            k = (r.compare_type, r.is_case_sensitive, tuple(r.more_context_sents))
+            if k not in groups:
+                groups[k] = CompiledRuleGroup(r.compare_type, r.is_case_sensitive, r.more_context_sents)
+                rule_groups.append(groups[k])
+            groups[k].add_rule(idx, r)
+        for g in rule_groups:
+            g.compile()
+        # executors are shared by threads, only publish the groups once they are complete
+        self._cut_off_rules = cut_off_rules
+        self._rule_groups = rule_groups
+        logger.debug('%s filter rules compiled into %s groups' % (len(self._filter_rules), len(rule_groups)))
 
     @staticmethod
     def relocate_annotation_pos(t, s, e, string_orig):
-        if t[s:e] == string_orig:
-            return [s, e]
-        candidates = []
-        ito = re.finditer(r'\b(' + re.escape(string_orig) + r')\b',
-                    t, re.IGNORECASE)
-        for mo in ito:
-            # print mo.start(1), mo.end(1), mo.group(1)
-            candidates.append({'dis': abs(s - mo.start(1)), 's': mo.start(1), 'e': mo.end(1), 'matched': mo.group(1)})
-        if len(candidates) == 0:
-            return [s, e]
-        candidates.sort(key=functools.cmp_to_key(lambda x1, x2: x1['dis'] - x2['dis']))
-        # print candidates[0]
-        return [candidates[0]['s'], candidates[0]['e']]
+        return AnnotationRelocator(t).relocate(s, e, string_orig)
 
     def execute(self, text, ann_start, ann_end, string_orig=None):
         # it seems necessary to relocate the original string because of encoding issues
@@ -138,27 +423,39 @@ class AnnRuleExecutor(object):
                     break
         return filtered, matched, rule_name
 
-    def execute_context_text(self, text, s_before, s_end, string_orig, start, end, more_context_sents=None):
+    def execute_context_text(self, text, s_before, s_end, string_orig, start, end, more_context_sents=None,
+                             cut_off_positions=None):
+        """
+        :param cut_off_positions: the anchor positions of the document (get_cut_off_positions),
+         computed here if not given
+        """
+        if self._compiled:
+            return self.execute_context_text_compiled(text, s_before, s_end, string_orig, start, end,
+                                                      more_context_sents=more_context_sents,
+                                                      cut_off_positions=cut_off_positions)
         filtered = False
         matched = []
         matched_rules = []
-        for r in self._filter_rules:
+        if len(self._filter_rules) > 0:
+            st = self.match_skip_term(string_orig)
+            if st is not None:
+                return True, [st], ['skip terms']
+        for idx, r in enumerate(self._filter_rules):
             rule_name = None
-            for st in self.skip_terms:
-                if st.lower() == string_orig.lower():
-                    return True, [st], 'skip terms'
             s_compare = s_end if r.compare_type > 0 else s_before
             if r.compare_type == 0:
                 s_compare = text[:_head_text_window_size]
             elif r.compare_type == 100:
                 s_compare = string_orig
             elif r.compare_type == -100:
-                in_cut_off = AnnRuleExecutor.cut_off_matching(text, r.reg_patterns, start)
-                if in_cut_off:
+                if cut_off_positions is None:
+                    cut_off_positions = self.get_cut_off_positions(text)
+                anchor_pos = cut_off_positions[idx]
+                if anchor_pos is not None and start >= anchor_pos:
                     filtered = True
                     matched.append('CUTOFF: %s' % r.name)
                     rule_name = r.name
-                    return filtered, matched, rule_name
+                    return filtered, matched, [rule_name]
                 else:
                     continue
 
@@ -184,8 +481,73 @@ class AnnRuleExecutor(object):
                 matched_rules.append(rule_name)
         return filtered, matched, matched_rules
 
+    def execute_context_text_compiled(self, text, s_before, s_end, string_orig, start, end,
+                                      more_context_sents=None, cut_off_positions=None):
+        """
+        the compiled version of execute_context_text, giving the same results
+        :return: (filtered, matched, matched_rules)
+        """
+        if len(self._filter_rules) == 0:
+            return False, [], []
+        st = self.match_skip_term(string_orig)
+        if st is not None:
+            return True, [st], ['skip terms']
+        if self._rule_groups is None:
+            self.compile_rules()
+        results = []
+        for g in self._rule_groups:
+            s_compare = s_end if g.compare_type > 0 else s_before
+            if g.compare_type == 0:
+                s_compare = text[:_head_text_window_size]
+            elif g.compare_type == 100:
+                s_compare = string_orig
+            if more_context_sents is not None and len(g.more_context_sents) > 0:
+                if -1 in g.more_context_sents and 'prev' in more_context_sents:
+                    s_compare = '%s %s' % (more_context_sents['prev'], s_compare)
+                if 1 in g.more_context_sents and 'next' in more_context_sents:
+                    s_compare = '%s %s' % (s_compare, more_context_sents['next'])
+            results += g.match(s_compare)
+        # report in rule order
+        results.sort(key=lambda x: x[0])
+        matched = [r[2] for r in results]
+        # a cut-off match stops the rule iteration, i.e., only earlier matches are kept
+        if cut_off_positions is None and len(self._cut_off_rules) > 0:
+            cut_off_positions = self.get_cut_off_positions(text)
+        for idx, r in self._cut_off_rules:
+            anchor_pos = cut_off_positions[idx]
+            if anchor_pos is not None and start >= anchor_pos:
+                matched = [m[2] for m in results if m[0] < idx]
+                matched.append('CUTOFF: %s' % r.name)
+                return True, matched, [r.name]
+        return len(results) > 0, matched, [r[1] for r in results]
+
     def add_original_string_filters(self, regs):
-        self._osf_rules += regs
+        """
+        add and compile original string filters, all filters are merged into one alternation
+        so that each annotation string only needs one match
+        :param regs: a list of regular expressions
+        :return:
+        """
+        for r in regs:
+            try:
+                self._osf_regs.append(re.compile(r))
+            except Exception as e:
+                raise ValueError('invalid original string filter [%s]: %s' % (r, e))
+            self._osf_rules.append(r)
+        self._osf_merged = None
+        self._osf_group_to_rule = {}
+        # group numbers shift in the merged pattern, so keep patterns with back references apart
+        if len([r for r in self._osf_rules if _group_ref_ptn.search(r)]) > 0:
+            return
+        group_idx = 1
+        for idx, reg_p in enumerate(self._osf_regs):
+            self._osf_group_to_rule[group_idx] = idx
+            group_idx += reg_p.groups + 1
+        try:
+            self._osf_merged = re.compile('|'.join(['(%s)' % r for r in self._osf_rules]))
+        except Exception:
+            logger.warning('failed to merge original string filters, they will be matched one by one')
+            self._osf_merged = None
 
     def execute_original_string_rules(self, string_orig):
         """
@@ -196,26 +558,106 @@ class AnnRuleExecutor(object):
         s_compare = string_orig
         filtered = False
         matched = []
-        for r in self._osf_rules:
-            try:
-                reg_p = re.compile(r)
-            except Exception:
-                logger.error('regs error: [%s]' % r['regs'])
-                exit(1)
-            # print 'matching %s on %s' % (reg_p, s_compare)
+        if self._osf_merged is not None:
+            # alternatives are tried in order, so this is the first matching filter
+            m = self._osf_merged.match(s_compare)
+            if m is not None:
+                matched.append([m.group(0), self._osf_rules[self._osf_group_to_rule[m.lastindex]]])
+                filtered = True
+            return filtered, matched
+        for idx, reg_p in enumerate(self._osf_regs):
             m = reg_p.match(s_compare)
             if m is not None:
-                # print m.group(0)
-                matched.append([m.group(0), r])
+                matched.append([m.group(0), self._osf_rules[idx]])
                 filtered = True
                 break
         return filtered, matched
 
+    @property
+    def rule_fingerprints(self):
+        """
+        fingerprints of the loaded rule files, keyed by the rule names used in ruled_by
+        (active rule files), 'skip terms' and 'osf:' prefixed original string filter files
+        """
+        return self._rule_fingerprints
+
+    @property
+    def record_rule_fingerprints(self):
+        """
+        whether ruled docs are serialised with the rule fingerprints, so that they can be re-analysed
+        incrementally later
+        """
+        return self._record_rule_fingerprints
+
+    @record_rule_fingerprints.setter
+    def record_rule_fingerprints(self, value):
+        self._record_rule_fingerprints = value
+
+    @property
+    def rule_names(self):
+        """
+        names of the filter rules in rule order without duplicates
+        """
+        names = []
+        for r in self._filter_rules:
+            if r.name not in names:
+                names.append(r.name)
+        return names
+
+    @property
+    def cut_off_rule_names(self):
+        names = []
+        for r in self._filter_rules:
+            if r.compare_type == -100 and r.name not in names:
+                names.append(r.name)
+        return names
+
+    def get_sub_executor(self, rule_names):
+        """
+        an executor with the filter rules of the given names and all cut-off rules, sharing
+        the skip terms and original string filters of this one. as cut-off rules stop the rule
+        iteration, it rules annotations the same way as this executor does, restricted to the given rules
+        :param rule_names:
+        :return: AnnRuleExecutor
+        """
+        sub = AnnRuleExecutor(compiled=self._compiled)
+        sub._filter_rules = [r for r in self._filter_rules if r.name in rule_names or r.compare_type == -100]
+        sub.skip_terms = self._skip_terms
+        sub._osf_rules = self._osf_rules
+        sub._osf_regs = self._osf_regs
+        sub._osf_merged = self._osf_merged
+        sub._osf_group_to_rule = self._osf_group_to_rule
+        return sub
+
+    def rules_could_match(self, rule_names, texts):
+        """
+        a cheap check of whether any filter rule of the given names could match a context
+        built from the texts, by the literals every match of a pattern has to contain
+        :param rule_names:
+        :param texts: the full text, annotation strings etc.
+        :return: False if none of the rules can match
+        """
+        check_text = '\0'.join([fold_text(t) for t in texts])
+        for r in self._filter_rules:
+            if r.name not in rule_names:
+                continue
+            if r.compare_type == -100:
+                # cut-off anchors are not regular expressions, no literal check
+                return True
+            for lits in r.literals:
+                if lits is None:
+                    return True
+                for l in lits:
+                    if _literal_could_occur(fold_text(l), check_text):
+                        return True
+        return False
+
     def load_rule_config(self, config_file):
         rule_config = utils.load_json_data(config_file)
         r_path = rule_config['rules_folder']
         logger.debug('loading rules from [%s]' % r_path)
         for rf in rule_config['active_rules']:
+            self._rule_fingerprints[rf] = utils.file_fingerprint(join(r_path, rf))
             for r in utils.load_json_data(join(r_path, rf)):
                 self.add_filter_rule(r['offset'], r['regs'], rule_name=rf,
                                      case_sensitive=r['case_sensitive'] if 'case_sensitive' in r else False,
@@ -224,18 +666,62 @@ class AnnRuleExecutor(object):
             logger.debug('%s loaded' % rf)
         if 'osf_rules' in rule_config:
             for osf in rule_config['osf_rules']:
+                self._rule_fingerprints['osf:%s' % osf] = utils.file_fingerprint(join(r_path, osf))
                 self.add_original_string_filters(utils.load_json_data(join(r_path, osf)))
                 logger.debug('original string filters from [%s] loaded' % osf)
         if 'skip_term_setting' in rule_config:
+            self._rule_fingerprints['skip terms'] = utils.file_fingerprint(rule_config['skip_term_setting'])
             self.skip_terms = utils.load_json_data(rule_config['skip_term_setting'])
+        if 'compiled_rules' in rule_config:
+            self.compiled = rule_config['compiled_rules']
+        if 'record_rule_fingerprints' in rule_config:
+            self.record_rule_fingerprints = rule_config['record_rule_fingerprints']
+
+    def get_cut_off_positions(self, text):
+        """
+        the anchor positions of all cut-off rules in a document, to be computed once per document
+        and passed to execute_context_text and get_cut_off_rule
+        :param text: the full text of the document
+        :return: a dict of rule index to its earliest anchor position (None if no anchor found)
+        """
+        cut_off_rules = [(idx, r) for idx, r in enumerate(self._filter_rules) if r.compare_type == -100]
+        text_lower = text.lower() if len(cut_off_rules) > 0 else None
+        positions = {}
+        for idx, r in cut_off_rules:
+            positions[idx] = AnnRuleExecutor.first_anchor_pos(text_lower, r.reg_patterns)
+        return positions
+
+    def get_cut_off_rule(self, text, start, cut_off_positions=None):
+        """
+        the first cut-off rule that applies to a position of a document
+        :param text: the full text of the document
+        :param start: the annotation start
+        :param cut_off_positions: the anchor positions of the document, computed here if not given
+        :return: the rule index or None
+        """
+        if cut_off_positions is None:
+            cut_off_positions = self.get_cut_off_positions(text)
+        for idx, anchor_pos in cut_off_positions.items():
+            if anchor_pos is not None and start >= anchor_pos:
+                return idx
+        return None
+
+    @staticmethod
+    def first_anchor_pos(text_lower, anchor_texts):
+        """
+        the earliest first occurrence of the anchor texts, an anchor at the very beginning
+        of the text does not cut off anything
+        :param text_lower: lower cased full text
+        :param anchor_texts: anchor strings
+        :return: the position or None
+        """
+        positions = [p for p in [text_lower.find(t.lower()) for t in anchor_texts] if p > 0]
+        return min(positions) if len(positions) > 0 else None
 
     @staticmethod
     def cut_off_matching(text, anchor_texts, check_pos):
-        for t in anchor_texts:
-            pos = text.lower().find(t.lower())
-            if check_pos >= pos > 0:
-                return True
-        return False
+        pos = AnnRuleExecutor.first_anchor_pos(text.lower(), anchor_texts)
+        return pos is not None and check_pos >= pos
 
 
 def test_filter_rules():
@@ -1,9 +1,15 @@
+import heapq
 import logging
 import os
-from os.path import isfile, join
+from os.path import isfile, join, abspath, dirname
 from os import listdir
 import re
+import shutil
 import sys
+import tempfile
+from collections import OrderedDict
+from functools import partial
+import re2
 from SemEHR.rule_extractor import ExtractRule
 from SemEHR.anony_ann_converter import AnnConverter
 import SemEHR.utils as utils
@@ -87,7 +93,9 @@ def anonymise_doc(doc_id, text, failed_docs, anonymis_inst, sent_container, rule
 
     sen_data = rets[0]
     # print 'sentdata : [%s]' % sen_data
-    anonymised_text = text
+    anonymised_text = None
+    # (pos, text) spans to replace, applied in one pass by ExtractRule.do_replace_all
+    replacements = []
     for d in sen_data:
         if 'SKIPDOC' in d['attrs']:
             anonymised_text = 'TOTALLY_IGNORED_CONTENT'
@@ -97,15 +105,16 @@ def anonymise_doc(doc_id, text, failed_docs, anonymis_inst, sent_container, rule
             logger.debug('removing %s [%s] [%s]' % (d['attrs']['name'], d['type'], d['rule']))
             start = d['attrs']['name_start']
             if is_valid_place_holder(d['attrs']['name']):
-                anonymised_text = ExtractRule.do_replace(anonymised_text, start, d['attrs']['name'])
-                # 'x' * len(d['attrs']['name']))
+                replacements.append((start, d['attrs']['name']))
             sent_container.append({'doc': doc_id, 'pos':d['pos'][0], 'start':start, 'type': d['type'], 'sent': d['attrs']['name'], 'rule': d['rule']})
         if 'number' in d['attrs']:
             logger.debug('removing %s [%s] [%s]' % (d['attrs']['number'], d['type'], d['rule']))
             # XXX should we change 'start' in the same way as for 'name' above?
             if is_valid_place_holder(d['attrs']['number']):
-                anonymised_text = ExtractRule.do_replace(anonymised_text, d['pos'][0], d['attrs']['number'])
+                replacements.append((d['pos'][0], d['attrs']['number']))
             sent_container.append({'doc': doc_id, 'pos':d['pos'][0], 'start': d['pos'][0], 'type': d['type'], 'sent': d['attrs']['number'], 'rule':d['rule']})
+    if anonymised_text is None:
+        anonymised_text = ExtractRule.do_replace_all(text, replacements)
     if use_spacy:
         spacy_doc = spacy_nlp(anonymised_text)
         for ent in spacy_doc.ents:
@@ -115,6 +124,159 @@ def anonymise_doc(doc_id, text, failed_docs, anonymis_inst, sent_container, rule
     return anonymised_text, sen_data
 
 
+def _same_ignorecase(a, b):
+    """
+    whether two characters match each other case insensitively, as python regex matches them
+    """
+    if a.isascii() and b.isascii():
+        return a.lower() == b.lower()
+    return re.fullmatch(re.escape(a), b, re.IGNORECASE) is not None
+
+
+class PhraseMatcher(object):
+    """
+    find the case insensitive occurrences of sensitive phrases in a text with one scan of a
+    combined (longest first) alternation. The results are the same as searching and replacing
+    the phrases one by one (re.escape(phrase) with re.IGNORECASE), in phrase order.
+    The text and the phrases are folded (each character to a representative of the characters
+    it matches case insensitively) so that the alternation is case sensitive, it runs on RE2 when
+    the folded text is ASCII; every occurrence found is checked with the phrase's own pattern
+    """
+    def __init__(self, phrases, text):
+        self._phrases = phrases
+        self._text = text
+        distinct = sorted(set(phrases), key=lambda v: (-len(v), v))
+        self._ptns = dict((v, re.compile(re.escape(v), re.IGNORECASE)) for v in distinct)
+        self._occurrences = dict((v, []) for v in distinct)
+        if '' in self._occurrences:
+            self._occurrences[''] = list(range(len(text) + 1))
+            distinct.remove('')
+        if len(distinct) > 0:
+            self.find_occurrences(distinct)
+
+    @staticmethod
+    def fold_table(phrase_chars, text_chars):
+        """
+        map each phrase character to a representative of the phrase characters it matches case
+        insensitively, and the text characters matching a phrase character to its representative
+        :return: (dict of phrase characters to representatives, str.translate table for the text)
+        """
+        reps = {}
+        rep_list = []
+        ascii_reps = {}
+        # ASCII characters first, they only match other ASCII characters by lower case
+        for x in sorted(phrase_chars):
+            r = ascii_reps.get(x.lower()) if x.isascii() else \
+                next((o for o in rep_list if _same_ignorecase(x, o)), None)
+            if r is None:
+                r = x
+                rep_list.append(x)
+                if x.isascii():
+                    ascii_reps[x.lower()] = x
+            reps[x] = r
+        non_ascii_reps = [o for o in rep_list if not o.isascii()]
+        table = {}
+        for c in text_chars:
+            if c in reps:
+                r = reps[c]
+            elif c.isascii():
+                r = ascii_reps.get(c.lower())
+                if r is None:
+                    r = next((o for o in non_ascii_reps if _same_ignorecase(c, o)), None)
+            else:
+                r = next((o for o in rep_list if _same_ignorecase(c, o)), None)
+            if r is not None and r != c:
+                table[ord(c)] = r
+        return reps, table
+
+    def find_occurrences(self, distinct):
+        text = self._text
+        reps, table = self.fold_table(set(''.join(distinct)), set(text))
+        folded_text = text.translate(table) if len(table) > 0 else text
+        folded_to_phrases = {}
+        for v in distinct:
+            folded_to_phrases.setdefault(''.join(reps[x] for x in v), []).append(v)
+        alternation = '|'.join(re.escape(fv) for fv in folded_to_phrases)
+        if folded_text.isascii():
+            any_ptn = re2.compile(alternation.encode('utf-8'))
+            scan_text = folded_text.encode('ascii')
+        else:
+            any_ptn = re.compile(alternation)
+            scan_text = folded_text
+        candidates = {}
+        m = any_ptn.search(scan_text)
+        while m is not None:
+            # the longest phrase matched here, the phrases folded to its prefixes could match here too
+            p = m.start()
+            matched = m.group(0)
+            if matched not in candidates:
+                fv = matched.decode('ascii') if type(matched) is bytes else matched
+                candidates[matched] = [v for i in range(1, len(fv) + 1) for v in folded_to_phrases.get(fv[:i], [])]
+            for v in candidates[matched]:
+                if self._ptns[v].match(text, p) is not None:
+                    self._occurrences[v].append(p)
+            # restart at the next offset to find overlapping occurrences
+            m = any_ptn.search(scan_text, p + 1)
+
+    @staticmethod
+    def non_overlapping(starts, length, masked=None):
+        """
+        the matches re.finditer would find among all occurrences of a phrase, skipping the ones
+        overlapping masked offsets
+        """
+        matched = []
+        next_pos = 0
+        for p in starts:
+            if p < next_pos or (masked is not None and masked.find(1, p, p + length) >= 0):
+                continue
+            matched.append(p)
+            next_pos = p + length
+        return matched
+
+    def matches(self):
+        """
+        the matches of each phrase in the text
+        :return: a list of (start, matched string) tuples, in phrase and then offset order
+        """
+        ret = []
+        for v in self._phrases:
+            for p in self.non_overlapping(self._occurrences[v], len(v)):
+                ret.append((p, self._text[p:p + len(v)]))
+        return ret
+
+    @staticmethod
+    def apply_mask(text, masked, repl_char):
+        parts = []
+        pos = 0
+        s = masked.find(1)
+        while s >= 0:
+            e = masked.find(0, s)
+            if e < 0:
+                e = len(text)
+            parts.append(text[pos:s])
+            parts.append(repl_char * (e - s))
+            pos = e
+            s = masked.find(1, pos)
+        parts.append(text[pos:])
+        return ''.join(parts)
+
+    def redact(self, repl_char='Q'):
+        """
+        replace the phrases one after another by repl_char, as re.sub of each phrase would. A phrase
+        without characters matching repl_char cannot match replaced text so its occurrences outside the
+        replaced offsets are used; other phrases are searched in the replaced text
+        """
+        masked = bytearray(len(self._text))
+        for v in self._phrases:
+            if masked.find(1) < 0 or re.search(re.escape(repl_char), v, re.IGNORECASE) is None:
+                starts = self.non_overlapping(self._occurrences[v], len(v), masked)
+            else:
+                starts = [m.start() for m in self._ptns[v].finditer(self.apply_mask(self._text, masked, repl_char))]
+            for p in starts:
+                masked[p:p + len(v)] = b'\x01' * len(v)
+        return self.apply_mask(self._text, masked, repl_char)
+
+
 def wrap_anonymise_doc_by_file(fn, folder, rule_group, anonymised_folder, failed_docs, anonymis_inst, sent_container,
                                fields, sensitive_fields, do_ann=False):
     text = utils.read_text_file_as_string(join(folder, fn))
@@ -143,10 +305,9 @@ def wrap_anonymise_doc_by_file(fn, folder, rule_group, anonymised_folder, failed
         arr = ['\\b' +v +'\\b' for v in sents[f].strip().split(' ') if len(v) > 3]
         s2repls += arr
 
-    # Update sent_container with entities found in the document using rules
+    # Collect the entities found in the document using rules
     cur_sent_container = []
     anonymised_text, sen_data = anonymise_doc(fn, s, failed_docs, anonymis_inst, cur_sent_container, rule_group)
-    sent_container += cur_sent_container
 
     # Add the new entities to the list of regex in s2repls
     # presumably so that anything found via a rule will also be
@@ -157,33 +318,154 @@ def wrap_anonymise_doc_by_file(fn, folder, rule_group, anonymised_folder, failed
             s2repls.append(sd['sent'])
 
     # Look for all sensitive phrases/words in anonymised_text
-    # and append to sent_container
-    for v in s2repls:
-            ptn = re.compile(re.escape(v), re.IGNORECASE)
-            matches = re.finditer(ptn, anonymised_text)
-            for m in matches:
-                sent_container.append({'doc': fn, 'pos': m.span()[0], 'start': m.span()[0], 'sent': m.group(0), 'type': "PHI-replace"})
+    # and append to the entities of the document
+    phrase_matcher = PhraseMatcher(s2repls, anonymised_text)
+    for start, sent in phrase_matcher.matches():
+        cur_sent_container.append({'doc': fn, 'pos': start, 'start': start, 'sent': sent, 'type': "PHI-replace"})
+    # in one go, so that the records of a doc stay next to each other with threads too
+    sent_container += cur_sent_container
 
     # save eHost ann
     if do_ann:
         # SMI not used
-        # XXX I have introduced a bug here, the XML just accumulates records after each file... (was: cur_sent_container,fn)
-        ehost_data = AnnConverter.anonymisation_to_eHost(sent_container, fn)
+        ehost_data = AnnConverter.anonymisation_to_eHost(cur_sent_container, fn)
         utils.save_string(s, join(anonymised_folder, fn))
         utils.save_string(ehost_data, join(anonymised_folder, '%s.knowtator.xml' % fn))
     else:
         # SMI used
-        for v in s2repls:
-            ptn = re.compile(re.escape(v), re.IGNORECASE)
-            anonymised_text = ptn.sub('Q' * len(v), anonymised_text)
+        anonymised_text = phrase_matcher.redact('Q')
         utils.save_string(anonymised_text, join(anonymised_folder, fn))
     logger.info('%s anonymised' % fn)
 
 
+def init_anonymise_worker(rule_file, shard_folder):
+    """
+    create the state of an anonymisation worker process: its compiled rules and its PHI shard
+    """
+    return {'inst': ExtractRule(rule_file),
+            'shard': open(join(shard_folder, 'phi_%s.jsonl' % os.getpid()), 'wb')}
+
+
+def end_anonymise_worker(worker):
+    worker['shard'].close()
+
+
+def anonymise_file_in_worker(worker, doc_item, input_folder, rule_group, anonymised_folder,
+                             working_fields, sensitive_fields, annotation_mode):
+    """
+    anonymise a file in a worker process and append its PHI records to the worker's shard,
+    each line is [file index, record] so that the shards can be merged in file order
+    :param doc_item: (file index, file name)
+    :return: the failed docs
+    """
+    idx, fn = doc_item
+    failed_docs = []
+    sent_data = []
+    wrap_anonymise_doc_by_file(fn, input_folder, rule_group, anonymised_folder, failed_docs, worker['inst'],
+                               sent_data, fields=working_fields, sensitive_fields=sensitive_fields,
+                               do_ann=annotation_mode)
+    shard = worker['shard']
+    for s in sent_data:
+        shard.write(utils.json_dumps([idx, s]) + b'\n')
+    shard.flush()
+    return failed_docs
+
+
+def iter_phi_shards(shard_files):
+    """
+    stream the PHI records of worker shards in file order; each worker anonymises its files in
+    file order, so the shards are merged by file index
+    """
+    fds = [open(f, 'rb') for f in shard_files]
+    try:
+        for idx, s in heapq.merge(*[(utils.json_loads(l) for l in fd) for fd in fds], key=lambda r: r[0]):
+            yield s
+    finally:
+        for fd in fds:
+            fd.close()
+
+
+def save_phi_stream(sent_data, sent_data_file, sent_data_output):
+    """
+    save a stream of PHI records, with the records of each doc next to each other, as the extracted
+    PHI json array and the PHI grouped by type. The grouped lines are kept in a temporary file per type;
+    they include the doc so duplicates are only looked for within a doc
+    """
+    # the separator of json arrays, e.g., ', ' for stdlib json
+    sep = utils.json_dumps([0, 0])[2:-2]
+    type_folder = tempfile.mkdtemp(prefix='phi_types_', dir=dirname(abspath(sent_data_output)))
+    type_files = OrderedDict()
+    try:
+        with open(sent_data_file, 'wb') as wf:
+            wf.write(b'[')
+            prev_doc = None
+            doc_lines = set()
+            for i, s in enumerate(sent_data):
+                wf.write((sep if i > 0 else b'') + utils.json_dumps(s))
+                if s['doc'] != prev_doc:
+                    prev_doc = s['doc']
+                    doc_lines = set()
+                line = '\t'.join([s['doc'], str(s['pos']), s['sent']])
+                if (s['type'], line) in doc_lines:
+                    continue
+                doc_lines.add((s['type'], line))
+                if s['type'] not in type_files:
+                    type_files[s['type']] = open(join(type_folder, '%s.txt' % len(type_files)), 'w+b')
+                    type_files[s['type']].write(line.encode('utf-8'))
+                else:
+                    type_files[s['type']].write(b'\n' + line.encode('utf-8'))
+            wf.write(b']')
+        with open(sent_data_output, 'wb') as wf:
+            for t in type_files:
+                wf.write(('%s\n======\n' % t).encode('utf-8'))
+                type_files[t].seek(0)
+                shutil.copyfileobj(type_files[t], wf)
+                wf.write(b'\n\n')
+    finally:
+        for f in type_files.values():
+            f.close()
+        shutil.rmtree(type_folder)
+
+
+def anonymise_files_in_folder_mp(fns, input_folder, anonymised_folder, rule_file, sent_data_file, sent_data_output,
+                                 rule_group, working_fields, sensitive_fields, annotation_mode=False,
+                                 num_processes=None, chunk_size=20):
+    """
+    anonymise files in worker processes, each compiling the rules once and writing the PHI records
+    to its own JSONL shard; the shards are then merged into the PHI outputs by streaming
+    :return: the failed docs
+    """
+    failed_docs = []
+    shard_folder = tempfile.mkdtemp(prefix='phi_shards_', dir=dirname(abspath(sent_data_file)))
+    try:
+        with utils.TaskExecutor(num_workers=num_processes, mode='process', chunk_size=chunk_size,
+                                worker_init_func=partial(init_anonymise_worker, rule_file, shard_folder),
+                                worker_end_func=end_anonymise_worker) as executor:
+            for r in executor.map(anonymise_file_in_worker, enumerate(fns),
+                                  args=[input_folder, rule_group, anonymised_folder,
+                                        working_fields, sensitive_fields, annotation_mode], ordered=False):
+                if r.error is not None:
+                    logger.error('failed to anonymise %s: %s' % (r.item[1], r.error))
+                    failed_docs.append(r.item[1])
+                else:
+                    failed_docs += r.result
+        save_phi_stream(iter_phi_shards([join(shard_folder, f) for f in sorted(listdir(shard_folder))]),
+                        sent_data_file, sent_data_output)
+    finally:
+        shutil.rmtree(shard_folder)
+    return failed_docs
+
+
 def anonymise_files_in_folder_mt(input_folder, anonymised_folder, rule_file, sent_data_file, sent_data_output,
                                  rule_group, working_fields, sensitive_fields, annotation_mode=False,
-                                 num_threads=0):
+                                 num_threads=0, num_processes=0):
     fns = [f for f in listdir(input_folder) if isfile(join(input_folder, f))]
+    if num_processes > 0:
+        failed_docs = anonymise_files_in_folder_mp(fns, input_folder, anonymised_folder, rule_file, sent_data_file,
+                                                   sent_data_output, rule_group, working_fields, sensitive_fields,
+                                                   annotation_mode=annotation_mode, num_processes=num_processes)
+        logger.info('%s files anonymised in %s processes, %s failed' % (len(fns), num_processes, len(failed_docs)))
+        return
     anonymis_inst = ExtractRule(rule_file)
     failed_docs = []
     sent_data = []
@@ -201,20 +483,9 @@ def anonymise_files_in_folder_mt(input_folder, anonymised_folder, rule_file, sen
                                        input_folder, rule_group, anonymised_folder, failed_docs,
                                        anonymis_inst, sent_data,
                                        fields=working_fields, sensitive_fields=sensitive_fields, do_ann=annotation_mode)
-    utils.save_json_array(sent_data, sent_data_file)
-    # Make a list of all the 'type' attributes and their doc,pos,sent values
-    # e.g. t2sent['name'] = [ 'doc \t posN \t sent', ... ]
-    t2sent = {}
-    for s in sent_data:
-        if s['type'] not in t2sent:
-            t2sent[s['type']] = []
-        t2sent[s['type']].append('\t'.join([s['doc'], str(s['pos']), s['sent']]))
-    # Make sure there's no duplicates within each list
-    s = ''
-    for t in t2sent:
-        t2sent[t] = list(set(t2sent[t]))
-        s += '%s\n======\n%s\n\n' % (t, '\n'.join(t2sent[t]))
-    utils.save_string(s, sent_data_output)
+    # the same outputs as the process mode: the PHI json array and, per type, the 'doc \t pos \t sent'
+    # lines without duplicates
+    save_phi_stream(sent_data, sent_data_file, sent_data_output)
 
 
 def parse_imaging_reports(text):
@@ -261,6 +532,7 @@ def do_anonymisation_by_conf(conf_file):
     sensitive_fields = setttings['sensitive_fields']
     annotation_mode = setttings['annotation_mode'] if 'annotation_mode' in setttings else False
     number_threads = setttings['number_threads'] if 'number_threads' in setttings else 0
+    number_processes = setttings['number_processes'] if 'number_processes' in setttings else 0
     rule_files = [join(rules_folder, f) for f in listdir(rules_folder) if isfile(join(rules_folder, f))
                   and re.match(setttings['rule_file_pattern'], f)]
     use_spacy = setttings.get('use_spacy', False)
@@ -294,7 +566,7 @@ def do_anonymisation_by_conf(conf_file):
                                      sensitive_output, rule_group=rule_group,
                                      working_fields=working_fileds, sensitive_fields=sensitive_fields,
                                      annotation_mode=annotation_mode,
-                                     num_threads=number_threads)
+                                     num_threads=number_threads, num_processes=number_processes)
 
 
 if __name__ == "__main__":
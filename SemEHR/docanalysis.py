@@ -1,20 +1,46 @@
+import bisect
+import codecs
+import collections
+import concurrent.futures
+import hashlib
 import json
 import logging
 import multiprocessing
+import os
 import re
+import sys
+import threading
+import time
+from functools import partial
 from os.path import join, isfile, split, splitext
 from os import listdir
 import SemEHR.ann_post_rules as ann_post_rules
 import SemEHR.study_analyzer as study_analyzer
 import SemEHR.utils as utils
+try:
+    import ijson
+except ImportError:
+    ijson = None
 
 logger = logging.getLogger(__name__)
+# docs at least this large are parsed incrementally by iter_doc_anns (when ijson is installed)
+_incremental_min_bytes = 8 * 1024 * 1024
+_ijson_missing_logged = False
+
+
+def _intern(value):
+    """
+    intern low cardinality categorical strings (negation, semantic types etc.) so that all annotations share
+    one copy, free text and concept ids are not interned as the interned table would keep growing
+    """
+    return sys.intern(value) if type(value) is str else value
 
 
 class BasicAnn(object):
     """
     a simple NLP (Named Entity) annotation class
     """
+    __slots__ = ('_str', '_start', '_end', '_id')
 
     def __init__(self, str_, start, end):
         self._str = str_
@@ -69,7 +95,7 @@ class BasicAnn(object):
 
     @staticmethod
     def deserialise(jo):
-        ann = BasicAnn(jo['start'], jo['start'], jo['end'])
+        ann = BasicAnn(jo['str'], jo['start'], jo['end'])
         ann.id = jo['id']
         return ann
 
@@ -78,11 +104,12 @@ class ContextedAnn(BasicAnn):
     """
     a contextulised annotation class (negation/tempolarity/experiencer)
     """
+    __slots__ = ('_neg', '_temp', '_exp')
 
     def __init__(self, str_, start, end, negation, temporality, experiencer):
-        self._neg = negation
-        self._temp = temporality
-        self._exp = experiencer
+        self._neg = _intern(negation)
+        self._temp = _intern(temporality)
+        self._exp = _intern(experiencer)
         super(ContextedAnn, self).__init__(str_, start, end)
 
     @property
@@ -91,7 +118,7 @@ class ContextedAnn(BasicAnn):
 
     @negation.setter
     def negation(self, value):
-        self._neg = value
+        self._neg = _intern(value)
 
     @property
     def temporality(self):
@@ -99,7 +126,7 @@ class ContextedAnn(BasicAnn):
 
     @temporality.setter
     def temporality(self, value):
-        self._temp = value
+        self._temp = _intern(value)
 
     @property
     def experiencer(self):
@@ -107,7 +134,7 @@ class ContextedAnn(BasicAnn):
 
     @experiencer.setter
     def experiencer(self, value):
-        self._exp = value
+        self._exp = _intern(value)
 
     def serialise_json(self):
         dict_obj = super(ContextedAnn, self).serialise_json()
@@ -121,14 +148,16 @@ class PhenotypeAnn(ContextedAnn):
     """
     a simple customisable phenotype annotation (two attributes for customised attributes)
     """
+    __slots__ = ('_major_type', '_minor_type', '_ruled_by')
 
     def __init__(self, str_, start, end,
                  negation, temporality, experiencer,
                  major_type, minor_type):
         super(PhenotypeAnn, self).__init__(str_, start, end, negation, temporality, experiencer)
-        self._major_type = major_type
-        self._minor_type = minor_type
-        self._ruled_by = []
+        self._major_type = _intern(major_type)
+        self._minor_type = _intern(minor_type)
+        # most annotations are never ruled out, the list is created on first use
+        self._ruled_by = None
 
     @property
     def major_type(self):
@@ -136,10 +165,12 @@ class PhenotypeAnn(ContextedAnn):
 
     @major_type.setter
     def major_type(self, value):
-        self._major_type = value
+        self._major_type = _intern(value)
 
     @property
     def ruled_by(self):
+        if self._ruled_by is None:
+            self._ruled_by = []
         return self._ruled_by
 
     @property
@@ -148,17 +179,17 @@ class PhenotypeAnn(ContextedAnn):
 
     @minor_type.setter
     def minor_type(self, value):
-        self._minor_type = value
+        self._minor_type = _intern(value)
 
     def serialise_json(self):
         dict_ = super(PhenotypeAnn, self).serialise_json()
         dict_['major_type'] = self.major_type
         dict_['minor_type'] = self.minor_type
-        dict_['ruled_by'] = self.ruled_by
+        dict_['ruled_by'] = self._ruled_by if self._ruled_by is not None else []
         return dict_
 
     def add_ruled_by(self, rule_name):
-        if rule_name not in self._ruled_by:
+        if rule_name not in self.ruled_by:
             self._ruled_by.append(rule_name)
 
     @staticmethod
@@ -175,17 +206,19 @@ class SemEHRAnn(ContextedAnn):
     """
     SemEHR Annotation Class
     """
+    __slots__ = ('_cui', '_sty', '_pref', '_ann_type', '_study_concepts', '_ruled_by')
 
     def __init__(self, str_, start, end,
                  negation, temporality, experiencer,
                  cui, sty, pref, ann_type):
         super(SemEHRAnn, self).__init__(str_, start, end, negation, temporality, experiencer)
         self._cui = cui
-        self._sty = sty
+        self._sty = _intern(sty)
         self._pref = pref
-        self._ann_type = ann_type
-        self._study_concepts = []
-        self._ruled_by = []
+        self._ann_type = _intern(ann_type)
+        # most annotations have neither, the lists are created on first use
+        self._study_concepts = None
+        self._ruled_by = None
 
     @property
     def cui(self):
@@ -201,7 +234,7 @@ class SemEHRAnn(ContextedAnn):
 
     @sty.setter
     def sty(self, value):
-        self._sty = value
+        self._sty = _intern(value)
 
     @property
     def ann_type(self):
@@ -209,7 +242,7 @@ class SemEHRAnn(ContextedAnn):
 
     @ann_type.setter
     def ann_type(self, value):
-        self._ann_type = value
+        self._ann_type = _intern(value)
 
     @property
     def pref(self):
@@ -221,6 +254,8 @@ class SemEHRAnn(ContextedAnn):
 
     @property
     def study_concepts(self):
+        if self._study_concepts is None:
+            self._study_concepts = []
         return self._study_concepts
 
     @study_concepts.setter
@@ -228,15 +263,17 @@ class SemEHRAnn(ContextedAnn):
         self._study_concepts = value
 
     def add_study_concept(self, value):
-        if value not in self._study_concepts:
+        if value not in self.study_concepts:
             self._study_concepts.append(value)
 
     @property
     def ruled_by(self):
+        if self._ruled_by is None:
+            self._ruled_by = []
         return self._ruled_by
 
     def add_ruled_by(self, rule_name):
-        if rule_name not in self._ruled_by:
+        if rule_name not in self.ruled_by:
             self._ruled_by.append(rule_name)
 
     def serialise_json(self):
@@ -244,8 +281,8 @@ class SemEHRAnn(ContextedAnn):
         dict_obj['sty'] = self.sty
         dict_obj['cui'] = self.cui
         dict_obj['pref'] = self.pref
-        dict_obj['study_concepts'] = self.study_concepts
-        dict_obj['ruled_by'] = self.ruled_by
+        dict_obj['study_concepts'] = self._study_concepts if self._study_concepts is not None else []
+        dict_obj['ruled_by'] = self._ruled_by if self._ruled_by is not None else []
         return dict_obj
 
     @staticmethod
@@ -272,6 +309,9 @@ class SemEHRAnnDoc(object):
         self._sentences = []
         self._others = []
         self._doc = None
+        self._sent_starts = []
+        self._sent_max_ends = []
+        self._sent_pos = {}
 
     def load(self, json_doc, file_key=None):
         self._doc = json_doc
@@ -282,6 +322,7 @@ class SemEHRAnnDoc(object):
     def load_anns(self):
         all_anns = self._anns
         panns = self._phenotype_anns
+        sents = self._sentences
         if 'sentences' in self._doc:
             # is a SemEHRAnnDoc serialisation
             self._anns = [SemEHRAnn.deserialise(a) for a in self._doc['annotations']]
@@ -289,81 +330,114 @@ class SemEHRAnnDoc(object):
                 self._phenotype_anns = [PhenotypeAnn.deserialise(a) for a in self._doc['phenotypes']]
             self._sentences = [BasicAnn.deserialise(a) for a in self._doc['sentences']]
         else:
+            # collect all groups in one pass and sort each group once afterwards
             for anns in self._doc['annotations']:
                 for ann in anns:
                     t = ann['type']
                     if t == 'Mention':
-                        a = SemEHRAnn(ann['features']['string_orig'],
+                        features = ann['features']
+                        a = SemEHRAnn(features['string_orig'],
                                       int(ann['startNode']['offset']),
                                       int(ann['endNode']['offset']),
 
-                                      ann['features']['Negation'],
-                                      ann['features']['Temporality'],
-                                      ann['features']['Experiencer'],
+                                      features['Negation'],
+                                      features['Temporality'],
+                                      features['Experiencer'],
 
-                                      ann['features']['inst'],
-                                      ann['features']['STY'],
-                                      ann['features']['PREF'],
+                                      features['inst'],
+                                      features['STY'],
+                                      features['PREF'],
                                       t)
                         all_anns.append(a)
                         a.id = 'cui-%s' % len(all_anns)
                     elif t == 'Phenotype':
-                        a = PhenotypeAnn(ann['features']['string_orig'],
+                        features = ann['features']
+                        a = PhenotypeAnn(features['string_orig'],
                                          int(ann['startNode']['offset']),
                                          int(ann['endNode']['offset']),
 
-                                         ann['features']['Negation'],
-                                         ann['features']['Temporality'],
-                                         ann['features']['Experiencer'],
+                                         features['Negation'],
+                                         features['Temporality'],
+                                         features['Experiencer'],
 
-                                         ann['features']['majorType'],
-                                         ann['features']['minorType'])
+                                         features['majorType'],
+                                         features['minorType'])
                         panns.append(a)
                         a.id = 'phe-%s' % len(panns)
                     elif t == 'Sentence':
                         a = BasicAnn('Sentence',
                                      int(ann['startNode']['offset']),
                                      int(ann['endNode']['offset']))
-                        self._sentences.append(a)
-                        self._sentences = sorted(self._sentences, key=lambda x: x.start)
-                        a.id = 'sent-%s' % len(self._sentences)
+                        sents.append(a)
+                        a.id = 'sent-%s' % len(sents)
                     else:
                         self._others.append(ann)
 
-            sorted(all_anns, key=lambda x: x.start)
+            all_anns.sort(key=lambda x: x.start)
+            panns.sort(key=lambda x: x.start)
+        # sentences are sorted when being indexed
+        self.index_sentences()
+
+    def index_sentences(self):
+        """
+        sort the sentences by start offset and build a bisect-searchable index,
+        i.e., sorted start offsets, running maximum of end offsets and the
+        position of each sentence in the sorted list
+        :return:
+        """
+        self._sentences = sorted(self._sentences, key=lambda x: x.start)
+        self._sent_starts = [s.start for s in self._sentences]
+        self._sent_max_ends = []
+        max_end = None
+        for s in self._sentences:
+            max_end = s.end if max_end is None else max(max_end, s.end)
+            self._sent_max_ends.append(max_end)
+        self._sent_pos = {s: idx for idx, s in enumerate(self._sentences)}
+
+    def _check_sentence_index(self):
+        # sentences might have been added through the sentences property
+        if len(self._sent_pos) != len(self._sentences):
+            self.index_sentences()
 
     @property
     def file_key(self):
         return self._fk
 
     def get_ann_sentence(self, ann):
+        """
+        get the first sentence (in start offset order) overlapping with the annotation
+        :param ann:
+        :return:
+        """
+        self._check_sentence_index()
         sent = None
-        for s in self.sentences:
-            if ann.overlap(s):
-                sent = s
+        # sentences starting after the annotation ends can not overlap with it
+        hi = bisect.bisect_right(self._sent_starts, ann.end)
+        # sentences before idx all end before the annotation starts
+        idx = bisect.bisect_left(self._sent_max_ends, ann.start, 0, hi)
+        while idx < hi:
+            if ann.overlap(self._sentences[idx]):
+                sent = self._sentences[idx]
                 break
+            idx += 1
         if sent is None:
-            print('sentence not found for %s' % ann.__dict__)
+            print('sentence not found for %s' % ann.serialise_json())
             return None
         return sent
 
     def get_prev_sent(self, s):
-        self._sentences = sorted(self._sentences, key=lambda x: x.start)
-        for idx in range(len(self.sentences)):
-            if self.sentences[idx] == s:
-                if idx > 0:
-                    return self.sentences[idx - 1]
-                else:
-                    return None
+        self._check_sentence_index()
+        idx = self._sent_pos.get(s)
+        if idx is not None and idx > 0:
+            return self._sentences[idx - 1]
+        return None
 
     def get_next_sent(self, s):
-        self._sentences = sorted(self._sentences, key=lambda x: x.start)
-        for idx in range(len(self.sentences)):
-            if self.sentences[idx] == s:
-                if idx < len(self.sentences) - 1:
-                    return self.sentences[idx + 1]
-                else:
-                    return None
+        self._check_sentence_index()
+        idx = self._sent_pos.get(s)
+        if idx is not None and idx < len(self._sentences) - 1:
+            return self._sentences[idx + 1]
+        return None
 
     @property
     def annotations(self):
@@ -415,6 +489,72 @@ class WrapperTextReader(TextReader):
         return self._text
 
 
+class DocPrefetcher(object):
+    """
+    read ann docs and their full texts ahead of the workers with a pool of I/O threads, so that the
+    latency of (network) storage overlaps with rule evaluation. iterating it gives (ann doc path, future)
+    pairs in path order with at most `prefetch` docs read ahead; workers get the
+    (ann doc path, file key, json doc, full text) of a future by wait(). I/O time, the time workers
+    spent waiting for I/O and processing time are counted separately
+    """
+
+    def __init__(self, ann_doc_paths, text_reader, prefetch=32, io_threads=4):
+        self._paths = ann_doc_paths
+        self._text_reader = text_reader
+        self._prefetch = max(1, prefetch)
+        self._io_threads = max(1, io_threads)
+        self._lock = threading.Lock()
+        self._num_docs = 0
+        self._io_seconds = 0
+        self._wait_seconds = 0
+        self._process_seconds = 0
+
+    def _read(self, ann_doc_path):
+        t = time.time()
+        try:
+            file_key = splitext(split(ann_doc_path)[1])[0]
+            json_doc = utils.load_json_data(ann_doc_path)
+            return ann_doc_path, file_key, json_doc, self._text_reader.read_full_text(file_key)
+        finally:
+            with self._lock:
+                self._num_docs += 1
+                self._io_seconds += time.time() - t
+
+    def __iter__(self):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self._io_threads) as pool:
+            pending = collections.deque()
+            for p in self._paths:
+                pending.append((p, pool.submit(self._read, p)))
+                if len(pending) >= self._prefetch:
+                    yield pending.popleft()
+            while len(pending) > 0:
+                yield pending.popleft()
+
+    def wait(self, future):
+        """
+        :return: (ann doc path, file key, json doc, full text) of a prefetched doc, read errors are raised
+        """
+        t = time.time()
+        try:
+            return future.result()
+        finally:
+            with self._lock:
+                self._wait_seconds += time.time() - t
+
+    def add_process_seconds(self, secs):
+        with self._lock:
+            self._process_seconds += secs
+
+    @property
+    def stats(self):
+        return {'docs': self._num_docs, 'io_seconds': self._io_seconds, 'io_wait_seconds': self._wait_seconds,
+                'process_seconds': self._process_seconds}
+
+    def log_stats(self):
+        logger.info('%(docs)s docs read: %(io_seconds).1fs of I/O, workers waited %(io_wait_seconds).1fs '
+                    'for I/O and spent %(process_seconds).1fs processing' % self.stats)
+
+
 class DBTextReader(TextReader):
     def __init__(self, sql_temp, dbcnn_file):
         super().__init__()
@@ -441,6 +581,45 @@ class ESTextReader(TextReader):
             return None
 
 
+_cohort_ann_fields = ('sty', 'negation', 'experiencer', 'ruled_by', 'cui', 'pref')
+
+
+def iter_doc_anns(doc_path, fields, incremental_min_bytes=None):
+    """
+    iterate the annotations of a serialised SemEHRAnnDoc file as dicts of the given fields only, without
+    materialising sentences, phenotypes or annotation objects. large files are parsed incrementally
+    by ijson (when installed), smaller ones in one go, which is faster
+    :param doc_path:
+    :param fields: annotation fields to keep, missing ones are None
+    :param incremental_min_bytes: file size from which to parse incrementally, defaults to 8MB
+    """
+    global _ijson_missing_logged
+    if incremental_min_bytes is None:
+        incremental_min_bytes = _incremental_min_bytes
+    if ijson is None:
+        if not _ijson_missing_logged and os.path.getsize(doc_path) >= incremental_min_bytes:
+            _ijson_missing_logged = True
+            logger.info('ijson not installed, large ann files like %s are loaded in full' % doc_path)
+    elif os.path.getsize(doc_path) >= incremental_min_bytes:
+        with open(doc_path, 'rb') as f:
+            for ann in ijson.items(f, 'annotations.item', use_float=True):
+                if isinstance(ann, list):
+                    # Bio-YODIE output, not a SemEHRAnnDoc serialisation
+                    break
+                yield {k: ann.get(k) for k in fields}
+            else:
+                return
+    doc = utils.load_json_data(doc_path)
+    if 'sentences' in doc:
+        anns = doc['annotations']
+    else:
+        ann_doc = SemEHRAnnDoc()
+        ann_doc.load(doc)
+        anns = [a.serialise_json() for a in ann_doc.annotations]
+    for ann in anns:
+        yield {k: ann.get(k) for k in fields}
+
+
 class DocCohort(object):
     def __init__(self, d2p, processed_anns_folder, doc_id_pattern=r'(.*).json'):
         self._d2p = d2p
@@ -456,49 +635,65 @@ class DocCohort(object):
     def collect_semantic_types(self, value):
         self._stys = value
 
-    def collect_result(self, output_file, graph_file_path):
+    def collect_result(self, output_file, graph_file_path, process_num=None, chunk_size=100):
+        """
+        count the qualifying mentions of each concept per patient. docs are aggregated by chunks
+        in a process pool and the partial (patient, cui) counts are merged at the end
+        :param output_file: the concepts and patient to concept counts
+        :param graph_file_path: the counts as a list of [patient, concept label, count]
+        :param process_num: number of worker processes, defaults to the number of CPUs available
+        :param chunk_size: number of docs per task sent to a worker
+        """
         files = [f for f in listdir(self._doc_pth) if isfile(join(self._doc_pth, f))]
         f_did = []
         for f in files:
             sr = re.search(self._did_pattern, f, re.IGNORECASE)
             if sr:
                 f_did.append((f, sr.group(1)))
-        results = []
         logger.info('collecting results ...')
-        utils.multi_thread_tasking(lst=f_did, num_threads=10, process_func=DocCohort.collect_doc_anns_by_types,
-                                   args=[self._doc_pth, self.collect_semantic_types, results])
-        logger.info('total anns collected %s' % len(results))
-        ret = {'concepts': {}, 'p2c': {}}
-        for r in results:
-            if r['d'] in self._d2p:
-                p = self._d2p[r['d']]
-                if p not in ret['p2c']:
-                    ret['p2c'][p] = {}
-                pd = ret['p2c'][p]
-                if r['cui'] not in ret['concepts']:
-                    ret['concepts'][r['cui']] = r['pref']
-                if r['cui'] not in pd:
-                    pd[r['cui']] = 1
-                else:
-                    pd[r['cui']] += 1
-            else:
-                logger.error('doc %s not in cohort map' % r['d'])
+        counts = collections.Counter()
+        concepts = {}
+        num_errors = 0
+        chunks = [f_did[i:i + chunk_size] for i in range(0, len(f_did), chunk_size)]
+        if len(chunks) > 0:
+            num_procs = utils.available_cpus() if process_num is None else process_num
+            # the doc to patient map is shared with the forked workers copy-on-write
+            with utils.TaskExecutor(num_workers=min(num_procs, len(chunks)), mode='process',
+                                    init_func=init_cohort_worker,
+                                    init_args=(self._d2p, self._doc_pth, self.collect_semantic_types)) as executor:
+                # in order, so that concept labels are taken from the first doc mentioning them
+                for r in executor.map(collect_cohort_chunk_in_worker, chunks):
+                    if r.error is not None:
+                        num_errors += len(r.item)
+                        logger.error('failed to collect a chunk of %s docs: %s' % (len(r.item), r.error))
+                        continue
+                    c_counts, c_concepts, not_mapped, c_errors = r.result
+                    counts.update(c_counts)
+                    for cui in c_concepts:
+                        if cui not in concepts:
+                            concepts[cui] = c_concepts[cui]
+                    for d in not_mapped:
+                        logger.error('doc %s not in cohort map' % d)
+                    num_errors += c_errors
+        logger.info('total anns collected %s, %s docs failed' % (sum(counts.values()), num_errors))
+        ret = {'concepts': concepts, 'p2c': {}}
+        for (p, cui), n in counts.items():
+            if p not in ret['p2c']:
+                ret['p2c'][p] = {}
+            ret['p2c'][p][cui] = n
         utils.save_json_array(ret, output_file)
         utils.save_json_array(DocCohort.result_to_graph(ret), graph_file_path)
         logger.info('result collected')
 
     @staticmethod
     def collect_doc_anns_by_types(doc_tuple, dir_path, sem_types, container):
-        doc = utils.load_json_data(join(dir_path, doc_tuple[0]))
-        ann_doc = SemEHRAnnDoc(file_key=doc_tuple[1])
-        ann_doc.load(doc, doc_tuple[1])
-        for a in ann_doc.annotations:
-            if (sem_types is not None and a.sty in sem_types) \
-                    and a.negation == 'Affirmed' and a.experiencer == 'Patient' \
-                    and len(a.ruled_by) == 0:
-                container.append({'d': doc_tuple[1], 'cui': a.cui, 'pref': a.pref})
+        for a in iter_doc_anns(join(dir_path, doc_tuple[0]), _cohort_ann_fields):
+            if (sem_types is not None and a['sty'] in sem_types) \
+                    and a['negation'] == 'Affirmed' and a['experiencer'] == 'Patient' \
+                    and not a['ruled_by']:
+                container.append({'d': doc_tuple[1], 'cui': a['cui'], 'pref': a['pref']})
             else:
-                logger.debug('%s not in %s' % (a.sty, sem_types))
+                logger.debug('%s not in %s' % (a['sty'], sem_types))
 
     @staticmethod
     def result_to_graph(result):
@@ -512,11 +707,206 @@ class DocCohort(object):
         return sorted(g, key=lambda x: x[1].lower())
 
 
+_cohort_worker_ctx = None
+
+
+def init_cohort_worker(d2p, dir_path, sem_types):
+    global _cohort_worker_ctx
+    _cohort_worker_ctx = {'d2p': d2p, 'dir_path': dir_path, 'sem_types': sem_types}
+
+
+def collect_cohort_chunk_in_worker(doc_tuples):
+    """
+    aggregate the qualifying mentions of a chunk of docs in a pool worker
+    :return: (Counter of (patient, cui) to number of mentions, cui to pref, ids of docs not in the cohort map,
+     number of docs failed)
+    """
+    d2p = _cohort_worker_ctx['d2p']
+    counts = collections.Counter()
+    concepts = {}
+    not_mapped = []
+    num_errors = 0
+    for doc_tuple in doc_tuples:
+        anns = []
+        try:
+            DocCohort.collect_doc_anns_by_types(doc_tuple, _cohort_worker_ctx['dir_path'],
+                                                _cohort_worker_ctx['sem_types'], anns)
+        except Exception as e:
+            num_errors += 1
+            logger.error('failed to collect anns from %s: %s' % (doc_tuple[0], e))
+            continue
+        if len(anns) == 0:
+            continue
+        if doc_tuple[1] not in d2p:
+            not_mapped.append(doc_tuple[1])
+            continue
+        p = d2p[doc_tuple[1]]
+        for a in anns:
+            counts[(p, a['cui'])] += 1
+            if a['cui'] not in concepts:
+                concepts[a['cui']] = a['pref']
+    return counts, concepts, not_mapped, num_errors
+
+
+class DocLedger(object):
+    """
+    an append-only ledger of processed docs (ann files or chunks of combined ann files)
+    so that an interrupted run can skip them when restarted. records are written in batches.
+    the first line records the run (see start_run), records of another run are discarded
+    """
+    def __init__(self, ledger_file, batch_size=1000):
+        self._ledger_file = ledger_file
+        self._batch_size = batch_size
+        self._done = {}
+        self._pending = []
+        self._run_id = None
+        self._lock = threading.Lock()
+        self.load_data()
+
+    def load_data(self):
+        if not isfile(self._ledger_file):
+            return
+        content = utils.read_text_file_as_string(self._ledger_file)
+        if not content.endswith('\n'):
+            # a crash may have left a partial last record
+            content = content[:content.rfind('\n') + 1]
+            utils.save_string(content, self._ledger_file)
+        for l in content.split('\n'):
+            if l == '':
+                continue
+            if l.startswith('#run\t'):
+                self._run_id = l[len('#run\t'):]
+                continue
+            arr = l.split('\t')
+            self._done[arr[0]] = arr[1] if len(arr) > 1 else None
+        logger.info('%s processed records loaded from %s' % (len(self._done), self._ledger_file))
+
+    @property
+    def ledger_file(self):
+        return self._ledger_file
+
+    @property
+    def done(self):
+        return self._done
+
+    def is_done(self, key):
+        return key in self._done
+
+    def start_run(self, run_id):
+        """
+        set the run of this ledger, records of a different run (e.g., with other rules or another
+        output folder) are discarded so that their docs are processed again
+        :param run_id: a fingerprint of everything that changes the results of the docs
+        """
+        with self._lock:
+            if self._run_id != run_id and (len(self._done) > 0 or len(self._pending) > 0):
+                logger.warning('%s was recorded by a different run, processing all docs again' %
+                               self._ledger_file)
+                self._clear()
+            self._run_id = run_id
+
+    @staticmethod
+    def file_key(file_path):
+        """
+        the key of an input file, its name with its size and modification time so that
+        a file changed since it was recorded is processed again
+        """
+        st = os.stat(file_path)
+        return '%s:%s:%s' % (split(file_path)[1], st.st_size, st.st_mtime_ns)
+
+    def add(self, key, value=None):
+        with self._lock:
+            self._done[key] = value
+            self._pending.append(key if value is None else '%s\t%s' % (key, value))
+            if len(self._pending) >= self._batch_size:
+                self._flush()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if len(self._pending) == 0:
+            return
+        header = '#run\t%s\n' % self._run_id if self._run_id is not None and not isfile(self._ledger_file) else ''
+        with codecs.open(self._ledger_file, 'a', encoding='utf-8') as wf:
+            wf.write(header + ''.join([l + '\n' for l in self._pending]))
+            wf.flush()
+            os.fsync(wf.fileno())
+        self._pending = []
+
+    def clear(self):
+        """
+        forget all records, e.g., when the run has finished
+        """
+        with self._lock:
+            self._clear()
+
+    def _clear(self):
+        self._done = {}
+        self._pending = []
+        if isfile(self._ledger_file):
+            os.unlink(self._ledger_file)
+
+
+def get_sentence_context(ann_doc, sent, text, offset):
+    """
+    the texts around a sentence used by the context rules
+    :param ann_doc: the SemEHRAnnDoc
+    :param sent: the sentence annotation
+    :param text: full text
+    :param offset: the offset of the (relocated) annotations
+    :return: (sentence text, text prepended to s_before, text appended to s_end, more_context_sents)
+    """
+    context_text = text[sent.start + offset:sent.end + offset]
+    s_prefix = ''
+    s_suffix = ''
+    anchor_sent = sent
+
+    # gate has an issue with splitting sentences with a question mark in the middle
+    # which is quite often in clinical notes to specify not sure for a condition
+    # so, if the previous sentence ends with a question mark, then bring it in for ruling
+    prev_s = ann_doc.get_prev_sent(sent)
+    if prev_s is not None:
+        prev_s_text = text[prev_s.start + offset:prev_s.end + offset]
+        if prev_s_text.endswith('?') or prev_s_text.lower().endswith('e.g.'):
+            s_prefix = prev_s_text
+            anchor_sent = prev_s
+
+    if context_text.startswith('s '):  # or s_before == '' :
+        if prev_s is not None:
+            s_prefix = text[prev_s.start + offset:prev_s.end + offset] + s_prefix
+            anchor_sent = prev_s
+        else:
+            logger.debug('previous sentence not found %s' % sent.id)
+    if context_text.endswith('?'):
+        next_s = ann_doc.get_next_sent(sent)
+        if next_s is not None:
+            s_suffix = text[next_s.start + offset:next_s.end + offset]
+            anchor_sent = next_s
+    more_context_sents = {}
+    prev_s = ann_doc.get_prev_sent(anchor_sent)
+    if prev_s is not None:
+        more_context_sents['prev'] = text[prev_s.start + offset:prev_s.end + offset]
+    next_s = ann_doc.get_next_sent(anchor_sent)
+    if next_s is not None:
+        more_context_sents['next'] = text[next_s.start + offset:next_s.end + offset]
+    return context_text, s_prefix, s_suffix, more_context_sents
+
+
 def process_doc_rule(ann_doc, rule_executor, reader, text_key, study_analyzer_inst, reset_prev_concept=False):
-    study_concepts = study_analyzer_inst.study_concepts if study_analyzer_inst is not None else None
+    cui_to_concepts = study_analyzer_inst.cui_to_concepts if study_analyzer_inst is not None else None
     num_concepts = 0
     text = None
+    cut_off_positions = None
     rule = None
+    # per document caches: sentence contexts keyed by (sentence, offset),
+    # rule verdicts keyed by everything the rules can look at and the annotation relocators
+    sent_contexts = {}
+    rule_verdicts = {}
+    # one relocator for annotations and another for phenotypes: each remembers the offset shift
+    # of its own sequence, phenotypes restart from the beginning of the document
+    relocators = {}
     for ann in ann_doc.annotations + ann_doc.phenotypes:
         is_a_concept = False
         if type(ann) is PhenotypeAnn:
@@ -524,12 +914,11 @@ def process_doc_rule(ann_doc, rule_executor, reader, text_key, study_analyzer_in
         else:
             if reset_prev_concept:
                 ann.study_concepts = []
-            if study_concepts is not None:
-                for sc in study_concepts:
-                    if ann.cui in sc.concept_closure:
-                        ann.add_study_concept(sc.name)
-                        is_a_concept = True
-                        logger.info('%s [%s, %s] is one %s' % (ann.str, ann.start, ann.end, sc.name))
+            if cui_to_concepts is not None:
+                for sc_name in cui_to_concepts.get(ann.cui, []):
+                    ann.add_study_concept(sc_name)
+                    is_a_concept = True
+                    logger.info('%s [%s, %s] is one %s' % (ann.str, ann.start, ann.end, sc_name))
             else:
                 is_a_concept = True
 
@@ -537,70 +926,52 @@ def process_doc_rule(ann_doc, rule_executor, reader, text_key, study_analyzer_in
             # lazy reading to ignore unnecessary full text reading
             if text is None:
                 text = reader.read_full_text(text_key)  # .replace('\n', ' ')
+                # the cut-off anchors of the document, found once for all its annotations
+                cut_off_positions = rule_executor.get_cut_off_positions(text)
             sent = ann_doc.get_ann_sentence(ann)
             if sent is not None:
-                ruled = False
-                context_text = text[sent.start:sent.end]
                 offset_start = ann.start - sent.start
                 offset_end = ann.end - sent.start
                 offset = 0
-                anchor_sent = sent
+                if (sent, offset) not in sent_contexts:
+                    sent_contexts[(sent, offset)] = get_sentence_context(ann_doc, sent, text, offset)
+                context_text, s_prefix, s_suffix, more_context_sents = sent_contexts[(sent, offset)]
                 if context_text[offset_start:offset_end].lower() != ann.str.lower():
-                    [s, e] = ann_post_rules.AnnRuleExecutor.relocate_annotation_pos(text,
-                                                                                    ann.start, ann.end, ann.str)
+                    if type(ann) not in relocators:
+                        relocators[type(ann)] = ann_post_rules.AnnotationRelocator(text)
+                    [s, e] = relocators[type(ann)].relocate(ann.start, ann.end, ann.str)
                     offset = s - ann.start
                     logger.debug('offset not matching, relocated from %s,%s to %s,%s, offset: %s' %
                                   (ann.start, ann.end, s, e, offset))
-                    context_text = text[sent.start + offset:sent.end + offset]
+                    if (sent, offset) not in sent_contexts:
+                        sent_contexts[(sent, offset)] = get_sentence_context(ann_doc, sent, text, offset)
+                    context_text, s_prefix, s_suffix, more_context_sents = sent_contexts[(sent, offset)]
                     logger.debug('context text: %s' % context_text)
-                s_before = context_text[:offset_start]
-
-                # gate has an issue with splitting sentences with a question mark in the middle
-                # which is quite often in clinical notes to specify not sure for a condition
-                # so, if the previous sentence ends with a question mark, then bring it in for ruling
-                prev_s = ann_doc.get_prev_sent(sent)
-                if prev_s is not None:
-                    prev_s_text = text[prev_s.start + offset:prev_s.end + offset]
-                    if prev_s_text.endswith('?') or prev_s_text.lower().endswith('e.g.'):
-                        s_before = prev_s_text + s_before
-                        anchor_sent = prev_s
-
-                if context_text.startswith('s '):  # or s_before == '' :
-                    prev_s = ann_doc.get_prev_sent(sent)
-                    if prev_s is not None:
-                        s_before = text[prev_s.start + offset:prev_s.end + offset] + s_before
-                        anchor_sent = prev_s
-                    else:
-                        logger.debug('previous sentence not found %s' % sent.id)
-                s_end = context_text[offset_end:]
-                if context_text.endswith('?'):
-                    next_s = ann_doc.get_next_sent(sent)
-                    if next_s is not None:
-                        s_end = s_end + text[next_s.start + offset:next_s.end + offset]
-                        anchor_sent = next_s
-                more_context_sents = {}
-                prev_s = ann_doc.get_prev_sent(anchor_sent)
-                if prev_s is not None:
-                    more_context_sents['prev'] = text[prev_s.start + offset:prev_s.end + offset]
-                next_s = ann_doc.get_next_sent(anchor_sent)
-                if next_s is not None:
-                    more_context_sents['next'] = text[next_s.start + offset:next_s.end + offset]
+                s_before = s_prefix + context_text[:offset_start]
+                s_end = context_text[offset_end:] + s_suffix
 
                 str_orig = ann.str if context_text[offset_start:offset_end].lower() != ann.str.lower() else \
                     context_text[offset_start:offset_end]
                 # logger.debug('%s' % context_text)
                 logger.debug('[%s] <%s> [%s]' % (s_before, str_orig, s_end))
-                if not ruled:
+                # cut-off rules are the only ones looking at the annotation position
+                verdict_key = (s_before, s_end, str_orig, more_context_sents.get('prev'),
+                               more_context_sents.get('next'),
+                               rule_executor.get_cut_off_rule(text, ann.start + offset, cut_off_positions))
+                if verdict_key not in rule_verdicts:
                     # string orign rules - not used now
                     ruled, case_instance = rule_executor.execute_original_string_rules(str_orig)
                     if ruled:
                         rules = ['original-string-rule']
-                if not ruled:
-                    # post processing rules
-                    ruled, case_instance, rules = \
-                        rule_executor.execute_context_text(text, s_before, s_end, str_orig,
-                                                           ann.start + offset, ann.end + offset,
-                                                           more_context_sents=more_context_sents)
+                    else:
+                        # post processing rules
+                        ruled, case_instance, rules = \
+                            rule_executor.execute_context_text(text, s_before, s_end, str_orig,
+                                                               ann.start + offset, ann.end + offset,
+                                                               more_context_sents=more_context_sents,
+                                                               cut_off_positions=cut_off_positions)
+                    rule_verdicts[verdict_key] = ruled, rules
+                ruled, rules = rule_verdicts[verdict_key]
                 if ruled:
                     for rule in rules:
                         ann.add_ruled_by(rule)
@@ -632,10 +1003,34 @@ def analyse_doc_anns_file(ann_doc_path, rule_executor, text_reader, output_folde
                             study_analyzer_inst)
 
 
+def analyse_doc_anns_file_and_record(ann_doc_path, *args, ledger=None):
+    if analyse_doc_anns_file(ann_doc_path, *args) is not None:
+        ledger.add(DocLedger.file_key(ann_doc_path))
+
+
+def analyse_prefetched_doc(item, prefetcher, rule_executor, output_folder,
+                           fn_pattern='se_ann_%s.json', es_inst=None, es_output_index=None, es_output_doc='doc',
+                           study_analyzer_inst=None, ledger=None):
+    """
+    analyse an ann doc read by a DocPrefetcher
+    :param item: an (ann doc path, future) pair of the prefetcher
+    """
+    ann_doc_path, file_key, json_doc, read_obj = prefetcher.wait(item[1])
+    t = time.time()
+    try:
+        data = analyse_doc_anns(json_doc, file_key, rule_executor, WrapperTextReader(read_obj), output_folder,
+                                fn_pattern, es_inst, es_output_index, es_output_doc,
+                                study_analyzer_inst)
+    finally:
+        prefetcher.add_process_seconds(time.time() - t)
+    if ledger is not None and data is not None:
+        ledger.add(DocLedger.file_key(ann_doc_path))
+
+
 def analyse_doc_anns_line(line, rule_executor, text_reader, output_folder,
                           fn_pattern='se_ann_%s.json', es_inst=None, es_output_index=None, es_output_doc='doc',
                           study_analyzer_inst=None):
-    json_doc = json.loads(line)
+    json_doc = utils.json_loads(line)
     file_key = json_doc['docId']
     return analyse_doc_anns(json_doc, file_key, rule_executor, text_reader, output_folder,
                             fn_pattern, es_inst, es_output_index, es_output_doc,
@@ -661,7 +1056,10 @@ def analyse_doc_anns(json_doc, file_key, rule_executor, text_reader, output_fold
     reader = WrapperTextReader(text)
     process_doc_rule(ann_doc, rule_executor, reader, None, study_analyzer_inst)
     if es_inst is None:
-        utils.save_json_array(ann_doc.serialise_json(), join(output_folder, fn_pattern % ann_doc.file_key))
+        # without an output folder, the caller saves the returned results
+        if output_folder is not None:
+            utils.save_json_array(serialise_ruled_doc(ann_doc, rule_executor),
+                                  join(output_folder, fn_pattern % ann_doc.file_key))
     else:
         data = ann_doc.serialise_json()
         data['doc_id'] = file_key
@@ -673,7 +1071,121 @@ def analyse_doc_anns(json_doc, file_key, rule_executor, text_reader, output_fold
             for ann in data['annotations']:
                 index_ctx_concept(ann, contextualised_concept_index, ctx_doc_type, es_inst)
 
-    return ann_doc.serialise_json()
+    return serialise_ruled_doc(ann_doc, rule_executor)
+
+
+def serialise_ruled_doc(ann_doc, rule_executor, with_fingerprints=None):
+    """
+    serialise a ruled doc, together with the fingerprints of the rules applied for incremental re-analysis
+    if the rule executor records them (record_rule_fingerprints in the rule config) or with_fingerprints is True
+    """
+    data = ann_doc.serialise_json()
+    if with_fingerprints or (with_fingerprints is None and rule_executor.record_rule_fingerprints):
+        data['rule_fingerprints'] = rule_executor.rule_fingerprints
+        data['cut_off_rules'] = rule_executor.cut_off_rule_names
+    return data
+
+
+def reanalyse_doc_anns(json_doc, file_key, rule_executor, text_reader, study_analyzer_inst=None):
+    """
+    re-apply the rules whose rule files changed since a ruled doc was serialised, unchanged
+    rules are not evaluated and their results in ruled_by are kept
+    :param json_doc: a doc serialised by serialise_ruled_doc, fully re-analysed if without rule fingerprints
+    :param file_key:
+    :param rule_executor: the executor with the current rules
+    :param text_reader:
+    :param study_analyzer_inst:
+    :return: (the updated serialisation or None if failed, one of unchanged, skipped, partial and full)
+    """
+    old_fps = json_doc['rule_fingerprints'] if 'rule_fingerprints' in json_doc else None
+    new_fps = rule_executor.rule_fingerprints
+    if old_fps == new_fps:
+        return json_doc, 'unchanged'
+    ann_doc = SemEHRAnnDoc()
+    ann_doc.load(json_doc, file_key=file_key)
+    read_obj = text_reader.read_full_text(ann_doc.file_key)
+    text = read_obj['text'] if isinstance(read_obj, dict) else read_obj
+    if text is None:
+        logger.error('file [%s] full text not found' % ann_doc.file_key)
+        return None, 'error'
+    anns = ann_doc.annotations + ann_doc.phenotypes
+
+    full = old_fps is None or 'cut_off_rules' not in json_doc
+    changed = set()
+    if not full:
+        changed = set([k for k in set(old_fps) | set(new_fps) if old_fps.get(k) != new_fps.get(k)])
+        # skip terms, original string filters and cut-off rules stop the rule iteration,
+        # changing any of them can change the results of unchanged rules
+        full = len([k for k in changed if k == 'skip terms' or k.startswith('osf:')]) > 0 or \
+            len(changed & set(rule_executor.cut_off_rule_names + json_doc['cut_off_rules'])) > 0
+    if full:
+        for ann in anns:
+            del ann.ruled_by[:]
+        process_doc_rule(ann_doc, rule_executor, WrapperTextReader(text), None, study_analyzer_inst,
+                         reset_prev_concept=True)
+        return serialise_ruled_doc(ann_doc, rule_executor, with_fingerprints=True), 'full'
+
+    # a doc needs updating if a changed rule ruled any of its annotations or could rule one now
+    if len([r for ann in anns for r in ann.ruled_by if r in changed]) == 0 and \
+            not rule_executor.rules_could_match(changed, [text] + [ann.str for ann in anns]):
+        json_doc['rule_fingerprints'] = new_fps
+        json_doc['cut_off_rules'] = rule_executor.cut_off_rule_names
+        return json_doc, 'skipped'
+    kept = {}
+    for ann in anns:
+        kept[ann] = [r for r in ann.ruled_by if r not in changed]
+        del ann.ruled_by[:]
+    process_doc_rule(ann_doc, rule_executor.get_sub_executor(changed), WrapperTextReader(text), None,
+                     study_analyzer_inst, reset_prev_concept=True)
+    # ruled_by is in rule order
+    rule_order = {name: idx for idx, name in enumerate(rule_executor.rule_names)}
+    for ann in anns:
+        merged = kept[ann] + [r for r in ann.ruled_by if r not in kept[ann]]
+        merged.sort(key=lambda r: rule_order[r] if r in rule_order else -1)
+        ann.ruled_by[:] = merged
+    return serialise_ruled_doc(ann_doc, rule_executor, with_fingerprints=True), 'partial'
+
+
+def reanalyse_doc_anns_file(out_doc_path, rule_executor, text_reader, fn_pattern, study_analyzer_inst, results):
+    p, fn = split(out_doc_path)
+    m = re.match('^%s$' % re.escape(fn_pattern).replace('%s', '(.*)'), fn)
+    if m is None:
+        return
+    data, how = reanalyse_doc_anns(utils.load_json_data(out_doc_path), m.group(1), rule_executor, text_reader,
+                                   study_analyzer_inst=study_analyzer_inst)
+    if data is not None and how != 'unchanged':
+        utils.save_json_array(data, out_doc_path)
+    results.append(how)
+
+
+def reanalyse_doc_anns_folder(output_folder, full_text_folder, rule_config_file, study_folder=None,
+                              study_config='study.json', full_text_fn_ptn='%s.txt', fn_pattern='se_ann_%s.json',
+                              thread_num=10):
+    """
+    incrementally re-analyse the ruled docs in an output folder of process_doc_anns after rule files changed
+    :param output_folder: the output folder of process_doc_anns, docs are updated in place
+    :param full_text_folder:
+    :param rule_config_file:
+    :param study_folder:
+    :param study_config:
+    :param full_text_fn_ptn:
+    :param fn_pattern: the file name pattern of the output docs
+    :param thread_num:
+    :return: number of docs per outcome (unchanged, skipped, partial, full, error)
+    """
+    text_reader = FileTextReader(full_text_folder, full_text_fn_ptn)
+    ret = load_study_ruler(study_folder, rule_config_file, study_config)
+    results = []
+    utils.multi_thread_process_files(dir_path=output_folder,
+                                     file_extension='json',
+                                     num_threads=thread_num,
+                                     process_func=reanalyse_doc_anns_file,
+                                     args=[ret['ruler'], text_reader, fn_pattern, ret['sa'], results])
+    stats = {}
+    for how in results:
+        stats[how] = stats[how] + 1 if how in stats else 1
+    logger.info('incremental re-analysis done: %s' % stats)
+    return stats
 
 
 def index_ctx_concept(ann, concept_index, ctx_doc_type, es_inst):
@@ -703,11 +1215,196 @@ def load_study_ruler(study_folder, rule_config_file, study_config='study.json'):
     return {'sa': sa, 'ruler': ruler}
 
 
+# the state of a process pool worker, set once per worker by init_doc_ann_worker
+_worker_ctx = None
+
+
+def init_doc_ann_worker(ruler, sa, text_reader, output_folder, fn_pattern, done_docs=None):
+    global _worker_ctx
+    _worker_ctx = {'ruler': ruler, 'sa': sa, 'text_reader': text_reader,
+                   'output_folder': output_folder, 'fn_pattern': fn_pattern,
+                   'done_docs': done_docs if done_docs is not None else set()}
+
+
+def analyse_doc_anns_file_in_worker(ann_doc_path):
+    if analyse_doc_anns_file(ann_doc_path, _worker_ctx['ruler'], _worker_ctx['text_reader'],
+                             _worker_ctx['output_folder'], _worker_ctx['fn_pattern'],
+                             study_analyzer_inst=_worker_ctx['sa']) is None:
+        # so that the doc is counted as an error and not recorded as done
+        raise Exception('[%s] not analysed' % ann_doc_path)
+
+
+def combined_chunk_key(ann_file, start, end):
+    """
+    the ledger key of a chunk of a combined ann JSONL file
+    """
+    return '%s:%s-%s' % (DocLedger.file_key(ann_file), start, end)
+
+
+def combined_doc_key(chunk_key, doc_id):
+    """
+    the ledger key of a doc analysed in a chunk that had errors
+    """
+    return '%s#%s' % (chunk_key, doc_id)
+
+
+def analyse_doc_anns_chunk_in_worker(large_file, start, end):
+    """
+    analyse the docs in a chunk of a combined ann JSONL file, skipping those recorded as done
+    by an interrupted run
+    :return: (file, chunk start, chunk end, worker pid, number of docs done, number of errors, seconds spent,
+     result JSONL lines - None if results are saved per doc, ids of the docs done - None if there were no errors)
+    """
+    t = time.time()
+    num_done = 0
+    num_errors = 0
+    lines = [] if _worker_ctx['output_folder'] is None else None
+    doc_ids = []
+    chunk_key = combined_chunk_key(large_file, start, end) if len(_worker_ctx['done_docs']) > 0 else None
+    for line in utils.read_file_chunk(large_file, start, end).split(b'\n'):
+        if line.strip() == b'':
+            continue
+        try:
+            json_doc = utils.json_loads(line)
+            if chunk_key is not None and combined_doc_key(chunk_key, json_doc['docId']) in _worker_ctx['done_docs']:
+                continue
+            data = analyse_doc_anns(json_doc, json_doc['docId'], _worker_ctx['ruler'], _worker_ctx['text_reader'],
+                                    _worker_ctx['output_folder'], _worker_ctx['fn_pattern'],
+                                    study_analyzer_inst=_worker_ctx['sa'])
+            if data is None:
+                num_errors += 1
+                continue
+            if lines is not None:
+                data['docId'] = json_doc['docId']
+                lines.append(utils.json_dumps(data))
+            doc_ids.append(json_doc['docId'])
+            num_done += 1
+        except Exception as e:
+            num_errors += 1
+            logger.error('failed to analyse a doc at [%s, %s) of %s: %s' % (start, end, large_file, e))
+    return large_file, start, end, os.getpid(), num_done, num_errors, time.time() - t, lines, \
+        doc_ids if num_errors > 0 else None
+
+
+def log_worker_stats(worker_stats):
+    for pid in worker_stats:
+        st = worker_stats[pid]
+        logger.info('worker %s: %s docs, %s errors, %.1f docs/s' %
+                    (pid, st['done'], st['errors'], st['done'] / st['seconds'] if st['seconds'] > 0 else 0))
+    logger.info('post processing of ann docs done, %s docs, %s errors' %
+                (sum(st['done'] for st in worker_stats.values()),
+                 sum(st['errors'] for st in worker_stats.values())))
+
+
+def process_combined_ann_files(ann_files, ruler, sa, text_reader, output_folder, fn_pattern,
+                               output_jsonl=None, process_num=None, chunk_bytes=8 * 1024 * 1024, ledger=None):
+    """
+    stream combined ann JSONL files through a process pool by chunks of lines,
+    results are written in input order, either per doc or into one JSONL file
+    :param ann_files: combined ann JSONL files, each line a doc with its docId
+    :param ruler:
+    :param sa:
+    :param text_reader:
+    :param output_folder: where per doc results are saved if output_jsonl is None
+    :param fn_pattern:
+    :param output_jsonl: the single output JSONL file
+    :param process_num: number of worker processes, defaults to the number of CPUs available
+    :param chunk_bytes: approximate size of the chunks sent to the workers, resuming a run needs the same size
+    :param ledger: DocLedger of the processed chunks (and of the docs done in chunks with errors)
+     to skip them and to record new ones
+    :return: per worker stats
+    """
+    worker_stats = {}
+    wf = None
+    if output_jsonl is not None:
+        output_pos = None
+        if ledger is not None and len(ledger.done) > 0:
+            output_pos = max([int(v) for v in ledger.done.values() if v is not None] + [0])
+            file_keys = [DocLedger.file_key(f) + ':' for f in ann_files]
+            if not isfile(output_jsonl) or os.path.getsize(output_jsonl) < output_pos:
+                # the results of the recorded chunks are lost, start afresh
+                logger.warning('%s missing or shorter than recorded, restarting instead of resuming' % output_jsonl)
+                output_pos = None
+            elif any(not any(k.startswith(fk) for fk in file_keys) for k in ledger.done):
+                # the output has results of input files changed or removed since
+                logger.warning('input files changed since %s was written, restarting instead of resuming' %
+                               output_jsonl)
+                output_pos = None
+            if output_pos is None:
+                ledger.clear()
+        if output_pos is not None:
+            # drop results written after the last recorded chunk, those chunks will be redone
+            with open(output_jsonl, 'r+b') as f:
+                f.truncate(output_pos)
+            wf = open(output_jsonl, 'ab')
+            logger.info('resuming %s from byte %s' % (output_jsonl, output_pos))
+        else:
+            wf = open(output_jsonl, 'wb')
+
+    def write_chunk_result(result):
+        ann_file, start, end, pid, num_done, num_errors, secs, lines, doc_ids = result
+        if pid not in worker_stats:
+            worker_stats[pid] = {'done': 0, 'errors': 0, 'seconds': 0}
+        worker_stats[pid]['done'] += num_done
+        worker_stats[pid]['errors'] += num_errors
+        worker_stats[pid]['seconds'] += secs
+        if wf is not None:
+            for l in lines:
+                wf.write(l + b'\n')
+            wf.flush()
+        if ledger is not None:
+            # written results first, so that the ledger never runs ahead of the output
+            chunk_key = combined_chunk_key(ann_file, start, end)
+            output_pos = wf.tell() if wf is not None else None
+            if num_errors == 0:
+                ledger.add(chunk_key, output_pos)
+            else:
+                # the chunk is redone when resuming, only for the docs that failed
+                for doc_id in doc_ids:
+                    ledger.add(combined_doc_key(chunk_key, doc_id), output_pos)
+
+    try:
+        for ann_file in ann_files:
+            num_chunks = utils.multi_process_file_chunks(
+                ann_file, analyse_doc_anns_chunk_in_worker, write_chunk_result,
+                num_procs=process_num if process_num is not None else utils.available_cpus(),
+                chunk_bytes=chunk_bytes,
+                init_func=init_doc_ann_worker,
+                init_args=(ruler, sa, text_reader, output_folder if wf is None else None, fn_pattern,
+                           None if ledger is None else set(ledger.done)),
+                chunk_filter_func=None if ledger is None else
+                lambda start, end: not ledger.is_done(combined_chunk_key(ann_file, start, end)))
+            logger.info('%s processed in %s chunks' % (ann_file, num_chunks))
+    finally:
+        if wf is not None:
+            wf.close()
+        if ledger is not None:
+            ledger.flush()
+    return worker_stats
+
+
+def doc_ann_run_id(ruler, study_folder, study_config, full_text_folder, output_folder, fn_pattern, output_jsonl):
+    """
+    a fingerprint of the settings of a process_doc_anns run that change its results: the rules,
+    the study, the full texts and where results are written
+    """
+    study_fp = None
+    if study_folder is not None and study_folder != '' and isfile(join(study_folder, study_config)):
+        study_fp = utils.file_fingerprint(join(study_folder, study_config))
+    folders = [None if f is None else os.path.abspath(f)
+               for f in [study_folder, full_text_folder, output_folder, output_jsonl]]
+    run_settings = {'rules': ruler.rule_fingerprints, 'study': study_fp, 'folders': folders,
+                    'fn_pattern': fn_pattern}
+    return hashlib.sha1(json.dumps(run_settings, sort_keys=True).encode('utf-8')).hexdigest()
+
+
 def process_doc_anns(anns_folder, full_text_folder, rule_config_file, output_folder,
                      study_folder=None,
                      study_config='study.json', full_text_fn_ptn='%s.txt', fn_pattern='se_ann_%s.json',
                      thread_num=10, es_inst=None, es_text_field='', patient_id_field='', combined_anns=None,
-                     es_output_index=None, es_output_doc='doc'):
+                     es_output_index=None, es_output_doc='doc',
+                     parallel_mode='thread', process_num=None, chunk_size=20,
+                     output_jsonl=None, chunk_bytes=8 * 1024 * 1024, ledger=None, prefetch=0, io_threads=4):
     """
     multiple threading process doc anns
     :type thread_num: object
@@ -723,7 +1420,17 @@ def process_doc_anns(anns_folder, full_text_folder, rule_config_file, output_fol
     :param thread_num:
     :param es_inst: semquery.SemEHRES instance
     :param es_text_field: the full text filed name in the es index
-    :return:
+    :param parallel_mode: thread or process, process mode is for ann doc folders without es
+    :param process_num: number of worker processes, defaults to the number of CPUs available
+    :param chunk_size: number of ann docs sent to a worker process at a time
+    :param combined_anns: if not None, anns_folder contains combined ann JSONL files
+    :param output_jsonl: write the results of combined ann files into this JSONL file instead of one file per doc
+    :param chunk_bytes: approximate size of the chunks of combined ann files sent to the worker processes
+    :param ledger: DocLedger to skip docs processed by an interrupted run and to record processed ones
+    :param prefetch: number of ann docs and full texts read ahead of the worker threads in thread mode,
+     0 (default) to read them in the workers
+    :param io_threads: number of threads reading ahead
+    :return: per worker stats in process mode and for combined ann files
     """
     if es_inst is None:
         text_reader = FileTextReader(full_text_folder, full_text_fn_ptn)
@@ -732,26 +1439,68 @@ def process_doc_anns(anns_folder, full_text_folder, rule_config_file, output_fol
     ret = load_study_ruler(study_folder, rule_config_file, study_config)
     sa = ret['sa']
     ruler = ret['ruler']
+    if ledger is not None:
+        ledger.start_run(doc_ann_run_id(ruler, study_folder, study_config, full_text_folder, output_folder,
+                                        fn_pattern, output_jsonl))
 
     # for ff in [f for f in listdir(anns_folder) if isfile(join(anns_folder, f))]:
     #     analyse_doc_anns(join(anns_folder, ff), ruler, text_reader, output_folder, fn_pattern, sa)
-    if combined_anns is None:
-        utils.multi_thread_process_files(dir_path=anns_folder,
-                                         file_extension='json',
-                                         num_threads=thread_num,
-                                         process_func=analyse_doc_anns_file,
-                                         args=[ruler, text_reader, output_folder, fn_pattern,
-                                               es_inst, es_output_index, es_output_doc,
-                                               sa])
-    else:
-        ann_files = [f for f in listdir(anns_folder) if isfile(join(anns_folder, f))]
-        for ann in ann_files:
-            utils.multi_process_large_file_tasking(
-                large_file=join(anns_folder, ann),
-                process_func=analyse_doc_anns_line,
-                args=[ruler, text_reader, output_folder, fn_pattern,
-                      es_inst, es_output_index, es_output_doc,
-                      sa])
+    try:
+        if combined_anns is None and parallel_mode == 'process' and es_inst is None:
+            ann_files = [join(anns_folder, f) for f in listdir(anns_folder)
+                         if isfile(join(anns_folder, f)) and f.endswith('.json')
+                         and (ledger is None or not ledger.is_done(DocLedger.file_key(join(anns_folder, f))))]
+            worker_stats = utils.multi_process_pool_tasking(
+                ann_files, analyse_doc_anns_file_in_worker,
+                num_procs=process_num if process_num is not None else utils.available_cpus(),
+                chunk_size=chunk_size,
+                init_func=init_doc_ann_worker,
+                init_args=(ruler, sa, text_reader, output_folder, fn_pattern),
+                done_func=None if ledger is None else lambda p: ledger.add(DocLedger.file_key(p)))
+            log_worker_stats(worker_stats)
+            return worker_stats
+        elif combined_anns is None and prefetch > 0:
+            ann_files = [join(anns_folder, f) for f in listdir(anns_folder)
+                         if isfile(join(anns_folder, f)) and f.endswith('.json')
+                         and (ledger is None or not ledger.is_done(DocLedger.file_key(join(anns_folder, f))))]
+            prefetcher = DocPrefetcher(ann_files, text_reader, prefetch=prefetch, io_threads=io_threads)
+            utils.multi_thread_tasking_it(prefetcher, thread_num, analyse_prefetched_doc,
+                                          args=[prefetcher, ruler, output_folder, fn_pattern,
+                                                es_inst, es_output_index, es_output_doc,
+                                                sa, ledger])
+            prefetcher.log_stats()
+        elif combined_anns is None:
+            utils.multi_thread_process_files(dir_path=anns_folder,
+                                             file_extension='json',
+                                             num_threads=thread_num,
+                                             process_func=analyse_doc_anns_file if ledger is None
+                                             else partial(analyse_doc_anns_file_and_record, ledger=ledger),
+                                             file_filter_func=None if ledger is None
+                                             else lambda f: f.endswith('.json') and
+                                             not ledger.is_done(DocLedger.file_key(join(anns_folder, f))),
+                                             args=[ruler, text_reader, output_folder, fn_pattern,
+                                                   es_inst, es_output_index, es_output_doc,
+                                                   sa])
+        elif es_inst is None:
+            ann_files = sorted([join(anns_folder, f) for f in listdir(anns_folder)
+                                if isfile(join(anns_folder, f))])
+            worker_stats = process_combined_ann_files(ann_files, ruler, sa, text_reader, output_folder, fn_pattern,
+                                                      output_jsonl=output_jsonl, process_num=process_num,
+                                                      chunk_bytes=chunk_bytes, ledger=ledger)
+            log_worker_stats(worker_stats)
+            return worker_stats
+        else:
+            ann_files = [f for f in listdir(anns_folder) if isfile(join(anns_folder, f))]
+            for ann in ann_files:
+                utils.multi_process_large_file_tasking(
+                    large_file=join(anns_folder, ann),
+                    process_func=analyse_doc_anns_line,
+                    args=[ruler, text_reader, output_folder, fn_pattern,
+                          es_inst, es_output_index, es_output_doc,
+                          sa])
+    finally:
+        if ledger is not None:
+            ledger.flush()
 
     logger.info('post processing of ann docs done')
 
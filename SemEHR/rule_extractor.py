@@ -1,8 +1,49 @@
 import logging
+import sys
+from bisect import bisect_right
+from collections import OrderedDict
 import SemEHR.utils as utils
 import re2 as re
 
 logger = logging.getLogger(__name__)
+_non_space_ptn = re.compile(r'[^\n\s]')
+
+
+class CompiledRule(object):
+    """
+    an extraction rule compiled once: its RE2 object and its data_labels resolved to group indices
+    """
+    __slots__ = ('pattern', 'data_type', 'reg', 'labels', 'labels_complete')
+
+    def __init__(self, ro):
+        self.pattern = ro['pattern']
+        self.data_type = ro['data_type']
+        flag = 0
+        if 'multiline' in ro['flags']:
+            flag |= re.MULTILINE
+        if 'ignorecase' in ro['flags']:
+            flag |= re.IGNORECASE
+        self.reg = re.compile(ro['pattern'], flag)
+        labels = ro['data_labels'] if 'data_labels' in ro else []
+        self.labels = [(attr, attr + '_start', i + 1) for i, attr in enumerate(labels) if i < self.reg.groups]
+        # more labels than groups: the labelled groups of the first match are kept, as before
+        self.labels_complete = len(self.labels) == len(labels)
+
+    @staticmethod
+    def compile_rules(re_objs):
+        """
+        compile the enabled rules, rules failing to compile are logged and dropped
+        """
+        compiled = []
+        for ro in re_objs:
+            if 'disabled' in ro and ro['disabled']:
+                continue
+            try:
+                compiled.append(CompiledRule(ro))
+            except Exception as ex:
+                logger.error('failed to compile rule %s: %s' % (ro['pattern'], ex))
+                print(ex, ro['pattern'], file=sys.stderr)
+        return compiled
 
 
 class ExtractRule(object):
@@ -11,6 +52,7 @@ class ExtractRule(object):
     """
     def __init__(self, rule_files):
         self._rules = {}
+        self._compiled = {}
         self.load_rule_files(rule_files)
 
     def load_rule_files(self, rule_files):
@@ -23,37 +65,40 @@ class ExtractRule(object):
                     temp_d = self._rules[k].copy()
                     temp_d.update(rules[k])
                     self._rules[k] = temp_d
+        self.compile_rule_groups()
+
+    def compile_rule_groups(self):
+        """
+        compile every rule group (a dict of rule types to rules) once, see do_full_text_parsing
+        """
+        self._compiled = {}
+        for k in self._rules:
+            group = self._rules[k]
+            if not isinstance(group, dict) or 'pattern' in group:
+                continue
+            self._compiled[k] = [(st, CompiledRule.compile_rules(group[st] if type(group[st]) is list
+                                                                 else [group[st]]))
+                                 for st in group]
 
     @staticmethod
-    def rul_extraction(full_text, re_objs):
+    def compiled_extraction(full_text, compiled_rules):
         results = []
-        for ro in re_objs:
-            if 'disabled' in ro and ro['disabled']:
-                continue
-            flag = 0
-            if 'multiline' in ro['flags']:
-                flag |= re.MULTILINE
-            if 'ignorecase' in ro['flags']:
-                flag |= re.IGNORECASE
-            try:
-                matches = re.finditer(ro['pattern'], full_text, flag)
-                for m in matches:
-                    ret = {'type': ro['data_type'], 'rule': ro['pattern'], 'attrs': {}}
-                    results.append(ret)
-                    ret['attrs']['full_match'] = m.group(0)
-                    ret['pos'] = m.span()
-                    i = 1
-                    if 'data_labels' in ro:
-                        for attr in ro['data_labels']:
-                            ret['attrs'][attr] = m.group(i)
-                            ret['attrs'][attr + '_start'] = m.start(i)
-                            i += 1
-            except Exception as ex:
-                import traceback
-                logger.error(traceback.format_exc())
-                print(ex, ro['pattern'], file=sys.stderr)
+        for cr in compiled_rules:
+            for m in cr.reg.finditer(full_text):
+                attrs = {'full_match': m.group(0)}
+                for attr, attr_start, i in cr.labels:
+                    attrs[attr] = m.group(i)
+                    attrs[attr_start] = m.start(i)
+                results.append({'type': cr.data_type, 'rule': cr.pattern, 'attrs': attrs, 'pos': m.span()})
+                if not cr.labels_complete:
+                    logger.error('rule %s has more data_labels than groups' % cr.pattern)
+                    break
         return results
 
+    @staticmethod
+    def rul_extraction(full_text, re_objs):
+        return ExtractRule.compiled_extraction(full_text, CompiledRule.compile_rules(re_objs))
+
     def do_letter_parsing(self, full_text):
         re_exps = self._rules
         results = []
@@ -77,15 +122,60 @@ class ExtractRule(object):
         return results, header_pos, tail_pos
 
     def do_full_text_parsing(self, full_text, rule_group='sent_rules'):
-        re_exps = self._rules
         matched_rets = []
-        for st in re_exps[rule_group]:
-            rules = re_exps[rule_group][st]
-            matched_rets += self.rul_extraction(full_text, rules if type(rules) is list else [rules])
+        for st, compiled_rules in self._compiled[rule_group]:
+            matched_rets += self.compiled_extraction(full_text, compiled_rules)
         return matched_rets, 0, 0
 
+    @staticmethod
+    def mask_text(sent_text, replace_char='x'):
+        return _non_space_ptn.sub(replace_char.replace('\\', '\\\\'), sent_text)
+
     @staticmethod
     def do_replace(text, pos, sent_text, replace_char='x'):
-        return text[:pos] + re.sub(r'[^\n\s]', 'x', sent_text) + text[pos+len(sent_text):]
+        return text[:pos] + ExtractRule.mask_text(sent_text, replace_char) + text[pos+len(sent_text):]
+
+    @staticmethod
+    def do_replace_all(text, replacements, replace_char='x'):
+        """
+        the same as calling do_replace for each replacement in turn, in one pass over the text:
+        the replaced spans are merged into regions, the replacements written into the region buffers
+        (in order, later ones overwrite earlier ones) and the text joined once
+        :param text: the text
+        :param replacements: a list of (pos, sent_text) tuples
+        :param replace_char: the character replacing the non-whitespace characters of a sent_text
+        :return: the replaced text
+        """
+        if len(replace_char) != 1:
+            # masks have to keep the length of the replaced spans
+            raise Exception('replace_char [%s] is not a single character' % replace_char)
+        # an identical later replacement overwrites the earlier one
+        unique_reps = OrderedDict()
+        for r in replacements:
+            unique_reps.pop(r, None)
+            unique_reps[r] = None
+        regions = []
+        for start, end in sorted((pos, pos + len(sent_text)) for pos, sent_text in unique_reps):
+            if len(regions) > 0 and start <= regions[-1][1]:
+                regions[-1][1] = max(regions[-1][1], end)
+            else:
+                regions.append([start, end])
+        region_starts = [r[0] for r in regions]
+        buffers = [list(text[start:end]) for start, end in regions]
+        masks = {}
+        for pos, sent_text in unique_reps:
+            if sent_text not in masks:
+                masks[sent_text] = ExtractRule.mask_text(sent_text, replace_char)
+            i = bisect_right(region_starts, pos) - 1
+            offset = pos - region_starts[i]
+            buffers[i][offset:offset + len(sent_text)] = masks[sent_text]
+        parts = []
+        prev_end = 0
+        for (start, end), buf in zip(regions, buffers):
+            parts.append(text[prev_end:start])
+            parts.append(''.join(buf))
+            prev_end = end
+        parts.append(text[prev_end:])
+        return ''.join(parts)
 
 
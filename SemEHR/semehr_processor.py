@@ -243,11 +243,50 @@ def do_semehr_doc_anns_analysis(settings):
     thread_num = settings.get_attr(['doc_ann_analysis', 'thread_num'])
     if thread_num is None:
         thread_num = 10
+    parallel_mode = settings.get_attr(['doc_ann_analysis', 'parallel_mode'])
+    if parallel_mode is None:
+        parallel_mode = 'thread'
+    process_num = settings.get_attr(['doc_ann_analysis', 'process_num'])
+    chunk_size = settings.get_attr(['doc_ann_analysis', 'chunk_size'])
+    if chunk_size is None:
+        chunk_size = 20
+    output_jsonl = settings.get_attr(['doc_ann_analysis', 'output_jsonl'])
+    chunk_bytes = settings.get_attr(['doc_ann_analysis', 'chunk_bytes'])
+    if chunk_bytes is None:
+        chunk_bytes = 8 * 1024 * 1024
+    # number of docs read ahead of the worker threads, e.g. 32 for full texts on network storage or es
+    prefetch = settings.get_attr(['doc_ann_analysis', 'prefetch'])
+    if prefetch is None:
+        prefetch = 0
+    io_threads = settings.get_attr(['doc_ann_analysis', 'io_threads'])
+    if io_threads is None:
+        io_threads = 4
+    json_backend = settings.get_attr(['doc_ann_analysis', 'json_backend'])
+    if json_backend is not None:
+        utils.set_json_backend(json_backend)
     process_mode = settings.get_attr(['doc_ann_analysis', 'process_mode'])
     if process_mode is not None and process_mode != 'sql':
         if settings.get_attr(['doc_ann_analysis', 'es_host']) is not None:
             raise Exception('using elasticsearch in this version is not supported')
+        elif settings.get_attr(['doc_ann_analysis', 'incremental']) == 'yes':
+            # only the rules changed, update the existing results
+            docanalysis.reanalyse_doc_anns_folder(output_folder=output_folder,
+                                                  full_text_folder=text_folder,
+                                                  rule_config_file=rule_config,
+                                                  study_folder=study_folder,
+                                                  full_text_fn_ptn=full_text_file_pattern,
+                                                  fn_pattern=output_file_pattern,
+                                                  thread_num=thread_num)
         else:
+            # with resume set to yes, record processed docs next to the job status file so that
+            # a failed run can be resumed
+            ledger = None
+            job_status_path = settings.get_attr(['job', 'job_status_file_path'])
+            if job_status_path is not None and settings.get_attr(['doc_ann_analysis', 'resume']) == 'yes':
+                ledger_batch_size = settings.get_attr(['doc_ann_analysis', 'ledger_batch_size'])
+                ledger = docanalysis.DocLedger(join(job_status_path,
+                                                    'semehr_doc_ledger_%s.txt' % settings.get_attr(['job', 'job_id'])),
+                                               batch_size=1000 if ledger_batch_size is None else ledger_batch_size)
             docanalysis.process_doc_anns(anns_folder=anns_folder,
                                          full_text_folder=text_folder,
                                          rule_config_file=rule_config,
@@ -255,8 +294,20 @@ def do_semehr_doc_anns_analysis(settings):
                                          study_folder=study_folder,
                                          full_text_fn_ptn=full_text_file_pattern,
                                          fn_pattern=output_file_pattern,
-                                         thread_num=thread_num
+                                         thread_num=thread_num,
+                                         parallel_mode=parallel_mode,
+                                         process_num=process_num,
+                                         chunk_size=chunk_size,
+                                         combined_anns=combined_anns,
+                                         output_jsonl=output_jsonl,
+                                         chunk_bytes=chunk_bytes,
+                                         ledger=ledger,
+                                         prefetch=prefetch,
+                                         io_threads=io_threads
                                          )
+            if ledger is not None:
+                # all done, the next run starts afresh
+                ledger.clear()
     else:
         ann_list_sql = settings.get_attr(['doc_ann_analysis', 'ann_list_sql'])
         primary_keys = settings.get_attr(['doc_ann_analysis', 'primary_keys'])
@@ -303,9 +354,10 @@ def collect_cohort_doc_results(settings, doc2pid):
     semantic_types = settings.get_attr(['cohort_doc_collection', 'semantic_types'])
     result_file_path = settings.get_attr(['cohort_doc_collection', 'result_file_path'])
     graph_file_path = settings.get_attr(['cohort_doc_collection', 'graph_file_path'])
+    process_num = settings.get_attr(['cohort_doc_collection', 'process_num'])
     dc = docanalysis.DocCohort(doc2pid, processed_ann_path, doc_id_pattern=ann_doc_pattern)
     dc.collect_semantic_types = semantic_types
-    dc.collect_result(result_file_path, graph_file_path)
+    dc.collect_result(result_file_path, graph_file_path, process_num=process_num)
 
 
 def do_patient_indexing(pid, es, doc_level_index, doc_ann_type,
@@ -74,6 +74,7 @@ class StudyAnalyzer(object):
         self._study_concepts = []
         self._skip_terms = []
         self._options = None
+        self._cui_to_concepts = None
 
     @property
     def study_name(self):
@@ -90,6 +91,28 @@ class StudyAnalyzer(object):
     @study_concepts.setter
     def study_concepts(self, value):
         self._study_concepts = value
+        self._cui_to_concepts = None
+
+    @property
+    def cui_to_concepts(self):
+        """
+        inverted index of CUI to the names of the study concepts whose closure contains it
+        """
+        # pickles do not carry the index
+        if getattr(self, '_cui_to_concepts', None) is None:
+            self.build_concept_index()
+        return self._cui_to_concepts
+
+    def build_concept_index(self):
+        """
+        build the CUI to study concept names index, names are in the order of study concepts
+        :return:
+        """
+        cui_to_concepts = {}
+        for sc in self.study_concepts:
+            for cui in sc.concept_closure:
+                cui_to_concepts.setdefault(cui, []).append(sc.name)
+        self._cui_to_concepts = cui_to_concepts
 
     @property
     def skip_terms(self):
@@ -101,6 +124,7 @@ class StudyAnalyzer(object):
 
     def add_concept(self, concept):
         self.study_concepts.append(concept)
+        self._cui_to_concepts = None
 
     def generate_exclusive_concepts(self):
         """
@@ -130,11 +154,13 @@ class StudyAnalyzer(object):
         #     print 'intersections [[\n%s\n]]' % json.dumps(explain_inter)
         # for sc in self.study_concepts:
         #     print '%s %s' % (sc.name, len(sc.concept_closure))
+        self.build_concept_index()
 
     def remove_study_concept_by_name(self, concept_name):
         for sc in self.study_concepts:
             if sc.name == concept_name:
                 self.study_concepts.remove(sc)
+        self._cui_to_concepts = None
 
     def retain_study_concepts(self, concept_names):
         retained = []
@@ -156,6 +182,13 @@ class StudyAnalyzer(object):
         jl.dump(self, out_file)
         print('serialised to %s' % out_file)
 
+    def __getstate__(self):
+        # the CUI index is derived from the concept closures, which are changed after loading
+        # (filtering, disjoint computing), so it is not pickled but rebuilt on first use
+        state = self.__dict__.copy()
+        state['_cui_to_concepts'] = None
+        return state
+
     @property
     def study_options(self):
         return self._options
@@ -1,10 +1,310 @@
 from os import listdir
 from os.path import isfile, join
-import queue as Queue
 import threading
 import json
 import codecs
+import collections
+import concurrent.futures
+import gc
+import hashlib
+import itertools
 import multiprocessing
+import multiprocessing.util
+import os
+import pickle
+import time
+from functools import partial
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+def available_cpus():
+    """
+    number of CPUs this process may run on (its CPU affinity), not the number of CPUs of the machine
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return multiprocessing.cpu_count()
+
+
+TaskResult = collections.namedtuple('TaskResult', ['item', 'result', 'error', 'worker', 'seconds'])
+
+# state of the current executor worker (a pool thread or process)
+_executor_worker = threading.local()
+
+
+def _init_executor_worker(func, args, in_process, counter, worker_objs, created_objs, init_func, init_args,
+                          worker_init_func, worker_end_func, worker_end_args, json_backend=None):
+    if json_backend is not None:
+        # the json backend selected in the parent, spawned workers would start with the default
+        set_json_backend(json_backend)
+    w = _executor_worker
+    w.func = func
+    w.args = () if args is None else tuple(args)
+    w.in_process = in_process
+    w.obj = None
+    if worker_objs is not None and len(worker_objs) > 0:
+        if in_process:
+            with counter.get_lock():
+                idx = counter.value
+                counter.value += 1
+        else:
+            idx = next(counter)
+        w.obj = worker_objs[idx % len(worker_objs)]
+    if init_func is not None:
+        init_func(*init_args)
+    if w.obj is None and worker_init_func is not None:
+        # created in the worker itself, so it may hold connections, file handles etc.
+        w.obj = worker_init_func()
+        if worker_end_func is not None:
+            if in_process:
+                # run when the worker process exits
+                multiprocessing.util.Finalize(None, worker_end_func, args=(w.obj,) + tuple(worker_end_args),
+                                              exitpriority=10)
+            else:
+                created_objs.append(w.obj)
+
+
+def _portable_error(e):
+    # exceptions go back to the parent process pickled, some can not be
+    try:
+        pickle.dumps(e)
+        return e
+    except Exception:
+        return Exception('%s: %s' % (type(e).__name__, e))
+
+
+def _execute_chunk(chunk, keep_results=True):
+    """
+    run the worker function on a chunk of items
+    :param keep_results: False to drop the results in the worker, so that they are not sent back
+     to the parent process
+    :return: (worker id, [(result, exception, seconds)] for each item, or [(exception, seconds)] without results)
+    """
+    w = _executor_worker
+    results = []
+    for item in chunk:
+        t = time.time()
+        try:
+            if w.obj is not None:
+                r = w.func(w.obj, item, *w.args)
+            else:
+                r = w.func(item, *w.args)
+            results.append((r, None, time.time() - t) if keep_results else (None, time.time() - t))
+        except Exception as e:
+            e = _portable_error(e) if w.in_process else e
+            results.append((None, e, time.time() - t) if keep_results else (e, time.time() - t))
+    return os.getpid() if w.in_process else threading.current_thread().name, results
+
+
+class TaskExecutor(object):
+    """
+    a bounded pool of worker threads or processes with the same API for both modes. items are read
+    lazily and sent to the workers in chunks, with at most max_pending chunks in flight, so that large
+    lists or iterators do not have to be queued up front. every item gets its result or exception back
+    """
+
+    def __init__(self, num_workers=None, mode='thread', chunk_size=1, max_pending=None,
+                 init_func=None, init_args=(), worker_objs=None, progress_func=None,
+                 worker_init_func=None, worker_end_func=None, worker_end_args=(), start_method=None):
+        """
+        :param num_workers: number of worker threads/processes, defaults to the number of CPUs available
+        :param mode: thread or process
+        :param chunk_size: number of items per task sent to a worker
+        :param max_pending: maximum number of chunks in flight, defaults to twice the number of workers
+        :param init_func: called once in each worker, e.g., to load models; module level in process mode
+        :param init_args: arguments of init_func
+        :param worker_objs: per worker objects, each worker passes one of them as the first argument
+         of the task function
+        :param progress_func: called in the calling thread as progress_func(num_done, num_errors)
+         after each chunk
+        :param worker_init_func: called in each worker (without a worker object) to create its worker object
+        :param worker_end_func: called as worker_end_func(worker_obj, *worker_end_args) for each object
+         created by worker_init_func when its worker ends, in the worker process in process mode
+        :param worker_end_args: extra arguments of worker_end_func
+        :param start_method: multiprocessing start method of process mode, defaults to fork where available
+         so that workers share the (read-only) state loaded by the parent copy-on-write
+        """
+        if mode not in ('thread', 'process'):
+            raise Exception('unsupported executor mode [%s]' % mode)
+        self._num_workers = max(1, available_cpus() if num_workers is None else num_workers)
+        self._mode = mode
+        self._chunk_size = max(1, chunk_size)
+        self._max_pending = 2 * self._num_workers if max_pending is None else max(1, max_pending)
+        self._init_func = init_func
+        self._init_args = init_args
+        self._worker_objs = worker_objs
+        self._progress_func = progress_func
+        self._worker_init_func = worker_init_func
+        self._worker_end_func = worker_end_func
+        self._worker_end_args = worker_end_args
+        if start_method is None and mode == 'process':
+            start_method = 'fork' if 'fork' in multiprocessing.get_all_start_methods() else None
+        self._start_method = start_method
+        self._created_objs = []
+        self._pool = None
+        self._cancelled = False
+
+    @property
+    def num_workers(self):
+        return self._num_workers
+
+    @property
+    def mode(self):
+        return self._mode
+
+    def _create_pool(self, func, args):
+        self._created_objs = []
+        if self._mode == 'process':
+            ctx = multiprocessing.get_context(self._start_method)
+            # func, args and worker objects reach the workers through the initializer, i.e.,
+            # inherited without pickling when processes are forked
+            return concurrent.futures.ProcessPoolExecutor(
+                max_workers=self._num_workers, mp_context=ctx, initializer=_init_executor_worker,
+                initargs=(func, args, True, ctx.Value('i', 0), self._worker_objs, None,
+                          self._init_func, self._init_args,
+                          self._worker_init_func, self._worker_end_func, self._worker_end_args,
+                          get_json_backend()))
+        return concurrent.futures.ThreadPoolExecutor(
+            max_workers=self._num_workers, initializer=_init_executor_worker,
+            initargs=(func, args, False, itertools.count(), self._worker_objs, self._created_objs,
+                      self._init_func, self._init_args,
+                      self._worker_init_func, self._worker_end_func, self._worker_end_args))
+
+    def _end_workers(self):
+        if self._worker_end_func is not None:
+            for obj in self._created_objs:
+                self._worker_end_func(obj, *tuple(self._worker_end_args))
+        self._created_objs = []
+
+    def map(self, func, items, args=None, ordered=True, keep_results=True):
+        """
+        run func(item, *args), or func(worker_obj, item, *args) with worker objects, on all items
+        :param func: the task function, module level in process mode
+        :param items: a list or an iterator, consumed as the workers keep up
+        :param args: extra arguments of func
+        :param ordered: yield results in the order of items, otherwise as chunks complete
+        :param keep_results: False to drop the results in the workers, TaskResult.result is then None
+        :return: generator of TaskResult
+        """
+        self._cancelled = False
+        self._pool = self._create_pool(func, args)
+        if self._mode == 'process':
+            # the garbage collector would otherwise touch (and so copy) every object page inherited by
+            # the forked workers; frozen objects stay shared copy-on-write
+            gc.freeze()
+        it = iter(items)
+        pending = collections.deque()
+        exhausted = False
+        num_done = 0
+        num_errors = 0
+        try:
+            while True:
+                if self._cancelled:
+                    for c, f in pending:
+                        f.cancel()
+                while not exhausted and not self._cancelled and len(pending) < self._max_pending:
+                    chunk = list(itertools.islice(it, self._chunk_size))
+                    if len(chunk) == 0:
+                        exhausted = True
+                        break
+                    pending.append((chunk, self._pool.submit(_execute_chunk, chunk, keep_results)))
+                if len(pending) == 0:
+                    break
+                if ordered:
+                    chunk, f = pending.popleft()
+                else:
+                    concurrent.futures.wait([f for c, f in pending], return_when=concurrent.futures.FIRST_COMPLETED)
+                    chunk, f = next((c, f) for c, f in pending if f.done())
+                    pending.remove((chunk, f))
+                if f.cancelled():
+                    continue
+                try:
+                    worker, results = f.result()
+                except Exception as e:
+                    # the chunk could not be run or its results not be sent back
+                    worker, results = None, [(None, e, 0) if keep_results else (e, 0)] * len(chunk)
+                for item, res in zip(chunk, results):
+                    r, e, secs = res if keep_results else (None,) + res
+                    if e is None:
+                        num_done += 1
+                    else:
+                        num_errors += 1
+                    yield TaskResult(item, r, e, worker, secs)
+                if self._progress_func is not None:
+                    self._progress_func(num_done, num_errors)
+        finally:
+            for c, f in pending:
+                f.cancel()
+            self._pool.shutdown(wait=True)
+            self._pool = None
+            if self._mode == 'process':
+                gc.unfreeze()
+            self._end_workers()
+
+    def run(self, func, items, args=None, error_func=None, done_func=None):
+        """
+        run func on all items, see map, the results are dropped in the workers
+        :param error_func: called with each failed TaskResult, the error is printed by default
+        :param done_func: called with each item processed without errors
+        :return: per worker stats, a dict of worker id to {'done': n, 'errors': n, 'seconds': t}
+        """
+        worker_stats = {}
+        for r in self.map(func, items, args=args, ordered=False, keep_results=False):
+            if r.worker not in worker_stats:
+                worker_stats[r.worker] = {'done': 0, 'errors': 0, 'seconds': 0}
+            worker_stats[r.worker]['seconds'] += r.seconds
+            if r.error is None:
+                worker_stats[r.worker]['done'] += 1
+                if done_func is not None:
+                    done_func(r.item)
+            else:
+                worker_stats[r.worker]['errors'] += 1
+                if error_func is not None:
+                    error_func(r)
+                else:
+                    print(u'error doing {0} on {1} \n{2}'.format(func, r.item, str(r.error)))
+        return worker_stats
+
+    def cancel(self):
+        """
+        stop sending items to the workers, items not started yet are dropped
+        """
+        self._cancelled = True
+
+    def shutdown(self, cancel_pending=False):
+        if cancel_pending:
+            self.cancel()
+        if self._pool is not None:
+            self._pool.shutdown(wait=True, cancel_futures=cancel_pending)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown(cancel_pending=exc_type is not None)
+
+
+def _run_tasks(mode, items, num_workers, process_func, args=None, thread_wise_objs=None,
+               thread_init_func=None, thread_end_func=None, thread_end_args=()):
+    """
+    run the tasks of the multi_* helpers: per worker objects from thread_wise_objs, or created in each
+    worker by thread_init_func, are passed as the first argument of process_func and thread_end_func is
+    called with each created object when its worker ends
+    """
+    worker_objs = None
+    if isinstance(thread_wise_objs, list):
+        worker_objs = thread_wise_objs[:num_workers]
+    with TaskExecutor(num_workers=num_workers, mode=mode, worker_objs=worker_objs,
+                      worker_init_func=thread_init_func, worker_end_func=thread_end_func,
+                      worker_end_args=thread_end_args) as executor:
+        return executor.run(process_func, items, args=args)
 
 
 # list files in a folder and put them in to a queue for multi-threading processing
@@ -38,36 +338,9 @@ def multi_thread_tasking(lst, num_threads, process_func,
                          proc_desc='processed', args=None, multi=None,
                          file_filter_func=None, callback_func=None, thread_wise_objs=None,
                          thread_init_func=None, thread_end_func=None,):
-    num_pdfs = len(lst)
-    pdf_queque = Queue.Queue(num_pdfs)
-    # print('putting list into queue...')
-    for item in lst:
-        pdf_queque.put_nowait(item)
-    thread_num = min(num_pdfs, num_threads)
-    arr = [process_func] if args is None else [process_func] + args
-    arr.insert(0, pdf_queque)
-    # print('queue filled, threading...')
-    thread_objs = []
-    for i in range(thread_num):
-        tarr = arr[:]
-        thread_obj = None
-        if thread_wise_objs is not None and isinstance(thread_wise_objs, list):
-            thread_obj = thread_wise_objs[i]
-        if thread_obj is None and thread_init_func is not None:
-            thread_obj = thread_init_func()
-            thread_objs.append(thread_obj)
-        tarr.insert(0, thread_obj)
-        t = threading.Thread(target=multi_thread_do, args=tuple(tarr))
-        t.daemon = True
-        t.start()
-
-    # print('waiting jobs to finish')
-    pdf_queque.join()
-    if thread_end_func is not None:
-        for to in thread_objs:
-            if to is not None:
-                thread_end_func(to)
-    # print('{0} files {1}'.format(num_pdfs, proc_desc))
+    _run_tasks('thread', lst, max(1, min(len(lst), num_threads)), process_func, args=args,
+               thread_wise_objs=thread_wise_objs, thread_init_func=thread_init_func,
+               thread_end_func=thread_end_func)
     if callback_func is not None:
         callback_func(*tuple(args))
 
@@ -75,47 +348,85 @@ def multi_thread_tasking(lst, num_threads, process_func,
 def multi_thread_tasking_it(it_lst, num_threads, process_func,
                             proc_desc='processed', args=None, multi=None,
                             file_filter_func=None, callback_func=None, thread_wise_objs=None):
-    pdf_queque = Queue.Queue(1000)
-    thread_num = num_threads
-    arr = [process_func] if args is None else [process_func] + args
-    arr.insert(0, pdf_queque)
-    # print('queue filled, threading...')
-    for i in range(thread_num):
-        tarr = arr[:]
-        thread_obj = None
-        if thread_wise_objs is not None and isinstance(thread_wise_objs, list):
-            thread_obj = thread_wise_objs[i]
-        tarr.insert(0, thread_obj)
-        t = threading.Thread(target=multi_thread_do, args=tuple(tarr))
-        t.daemon = True
-        t.start()
-
-    # print('waiting jobs to finish')
-    # print('putting list into queue...')
-    for item in it_lst:
-        pdf_queque.put(item)
-    pdf_queque.join()
-    # print('{0} files {1}'.format(num_pdfs, proc_desc))
+    _run_tasks('thread', it_lst, num_threads, process_func, args=args, thread_wise_objs=thread_wise_objs)
     if callback_func is not None:
         callback_func(*tuple(args))
 
 
-def multi_thread_do(thread_obj, q, func, *args):
-    while True:
-        p = q.get()
-        try:
-            if thread_obj is not None:
-                func(thread_obj, p, *args)
-            else:
-                func(p, *args)
-        except Exception as e:
-            print(u'error doing {0} on {1} \n{2}'.format(func, p, str(e)))
-        q.task_done()
+def _stdlib_json_dumps(obj):
+    return json.dumps(obj).encode('utf-8')
+
+
+def _ujson_dumps(obj):
+    return ujson.dumps(obj, ensure_ascii=False, escape_forward_slashes=False).encode('utf-8')
+
+
+# json backends in order of preference: name -> (loads, dumps to utf-8 bytes, errors to retry with stdlib json)
+_json_backends = collections.OrderedDict()
+if orjson is not None:
+    _json_backends['orjson'] = (orjson.loads, orjson.dumps, (TypeError, ValueError))
+if ujson is not None:
+    _json_backends['ujson'] = (ujson.loads, _ujson_dumps, (TypeError, ValueError, OverflowError))
+_json_backends['json'] = (json.loads, _stdlib_json_dumps, ())
+_json_codec = None
+
+
+def json_backends():
+    """
+    names of the available json backends, fastest first
+    """
+    return list(_json_backends.keys())
+
+
+def set_json_backend(name=None):
+    """
+    select the json backend used by json_loads/json_dumps and the json file helpers,
+    TaskExecutor passes it on to its worker processes. NB: orjson writes NaN and Infinity
+    as null where the stdlib json writes NaN/Infinity literals
+    :param name: orjson, ujson or json; None for the fastest available one
+    """
+    global _json_codec
+    if name is None:
+        name = json_backends()[0]
+    if name not in _json_backends:
+        raise Exception('json backend [%s] not available, choose from %s' % (name, json_backends()))
+    _json_codec = (name,) + _json_backends[name]
+
+
+def get_json_backend():
+    return _json_codec[0]
+
+
+def json_loads(s):
+    """
+    parse json from str or utf-8 bytes
+    """
+    name, loads, dumps, retry_errors = _json_codec
+    try:
+        return loads(s)
+    except retry_errors:
+        # e.g. NaN/Infinity literals, which only the stdlib json accepts
+        return json.loads(s)
+
+
+def json_dumps(obj):
+    """
+    serialise obj as utf-8 encoded json bytes
+    """
+    name, loads, dumps, retry_errors = _json_codec
+    try:
+        return dumps(obj)
+    except retry_errors:
+        # e.g. non-str dict keys or integers beyond 64 bits
+        return _stdlib_json_dumps(obj)
 
 
 def save_json_array(lst, file_path, encoding='utf-8'):
-    with codecs.open(file_path, 'w', encoding=encoding) as wf:
-        json.dump(lst, wf)
+    data = json_dumps(lst)
+    if codecs.lookup(encoding).name != 'utf-8':
+        data = data.decode('utf-8').encode(encoding)
+    with open(file_path, 'wb') as wf:
+        wf.write(data)
 
 
 def save_string(str, file_path, encoding='utf-8'):
@@ -124,10 +435,19 @@ def save_string(str, file_path, encoding='utf-8'):
 
 
 def load_json_data(file_path):
-    data = None
-    with codecs.open(file_path, encoding='utf-8') as rf:
-        data = json.load(rf)
-    return data
+    with open(file_path, 'rb') as rf:
+        return json_loads(rf.read())
+
+
+set_json_backend()
+
+
+def file_fingerprint(file_path):
+    """
+    sha1 hex digest of a file's content
+    """
+    with open(file_path, 'rb') as rf:
+        return hashlib.sha1(rf.read()).hexdigest()
 
 
 def http_post_result(url, payload, headers=None, auth=None):
@@ -137,40 +457,20 @@ def http_post_result(url, payload, headers=None, auth=None):
     return str(req.content) # req.content.decode("utf-8")
 
 
+def _read_lines(large_file, file_encoding='utf-8'):
+    with codecs.open(large_file, encoding=file_encoding) as lf:
+        for line in lf:
+            yield line
+
+
 def multi_thread_large_file_tasking(large_file, num_threads, process_func,
                                     proc_desc='processed', args=None, multi=None,
                                     file_filter_func=None, callback_func=None,
                                     thread_init_func=None, thread_end_func=None,
                                     file_encoding='utf-8'):
-    num_queue_size = 1000
-    pdf_queque = Queue.Queue(num_queue_size)
-    print('queue filled, threading...')
-    thread_objs = []
-    for i in range(num_threads):
-        arr = [process_func] if args is None else [process_func] + args
-        to = None
-        if thread_init_func is not None:
-            to = thread_init_func()
-            thread_objs.append(to)
-        arr.insert(0, to)
-        arr.insert(1, pdf_queque)
-        t = threading.Thread(target=multi_thread_do, args=tuple(arr))
-        t.daemon = True
-        t.start()
-
-    print('putting list into queue...')
-    num_lines = 0
-    with codecs.open(large_file, encoding=file_encoding) as lf:
-        for line in lf:
-            num_lines += 1
-            pdf_queque.put(line)
-
-    print('waiting jobs to finish')
-    pdf_queque.join()
-    if thread_end_func is not None:
-        for to in thread_objs:
-            if to is not None:
-                thread_end_func(to)
+    worker_stats = _run_tasks('thread', _read_lines(large_file, file_encoding), num_threads, process_func,
+                              args=args, thread_init_func=thread_init_func, thread_end_func=thread_end_func)
+    num_lines = sum(s['done'] + s['errors'] for s in worker_stats.values())
     print('{0} lines {1}'.format(num_lines, proc_desc))
     if callback_func is not None:
         callback_func(*tuple(args))
@@ -190,23 +490,7 @@ def read_text_file_as_string(file_path, encoding='utf-8'):
     return s
 
 
-def multi_process_do(thread_obj, q, func, *args):
-    while True:
-        p = q.get()
-        if p == 'EMPTY-NOW':
-            q.task_done()
-            break
-        try:
-            if thread_obj is not None:
-                func(thread_obj, p, *args)
-            else:
-                func(p, *args)
-        except Exception as e:
-            print(u'error doing {0} on {1} \n{2}'.format(func, p, str(e)))
-        q.task_done()
-
-
-def multi_process_tasking(lst, process_func, num_procs=multiprocessing.cpu_count()*2,
+def multi_process_tasking(lst, process_func, num_procs=None,
                           proc_desc='processed', args=None, multi=None,
                           file_filter_func=None, callback_func=None, thread_wise_objs=None,
                           thread_init_func=None, thread_end_func=None, thread_end_args=[]):
@@ -221,80 +505,114 @@ def multi_process_tasking(lst, process_func, num_procs=multiprocessing.cpu_count
     :param file_filter_func:
     :param callback_func:
     :param thread_wise_objs:
-    :param thread_init_func:
-    :param thread_end_func:
+    :param thread_init_func: called in each worker process to create the object passed to process_func
+    :param thread_end_func: called with that object in its worker process when the worker ends
     :return:
     """
-    num_tasks = len(lst)
-    pdf_queque = multiprocessing.JoinableQueue(num_tasks)
-    for item in lst:
-        pdf_queque.put_nowait(item)
-    thread_num = min(num_tasks, num_procs)
-    arr = [process_func] if args is None else [process_func] + args
-    arr.insert(0, pdf_queque)
-    thread_objs = []
-    for i in range(thread_num):
-        tarr = arr[:]
-        thread_obj = None
-        if thread_wise_objs is not None and isinstance(thread_wise_objs, list):
-            thread_obj = thread_wise_objs[i]
-        if thread_obj is None and thread_init_func is not None:
-            thread_obj = thread_init_func()
-            thread_objs.append(thread_obj)
-        tarr.insert(0, thread_obj)
-        p = multiprocessing.Process(target=multi_process_do, args=tuple(tarr))
-        p.start()
-
-    for i in range(thread_num):
-        pdf_queque.put('EMPTY-NOW')
-    pdf_queque.join()
-    if thread_end_func is not None:
-        for to in thread_objs:
-            if to is not None:
-                thread_end_func(to, *tuple(thread_end_args))
+    if num_procs is None:
+        num_procs = available_cpus()
+    _run_tasks('process', lst, max(1, min(len(lst), num_procs)), process_func, args=args,
+               thread_wise_objs=thread_wise_objs, thread_init_func=thread_init_func,
+               thread_end_func=thread_end_func, thread_end_args=thread_end_args)
     if callback_func is not None:
         callback_func(*tuple(args))
 
 
-def multi_process_large_file_tasking(large_file, process_func, num_procs=multiprocessing.cpu_count()*2,
+def multi_process_large_file_tasking(large_file, process_func, num_procs=None,
                                      proc_desc='processed', args=None, multi=None,
                                      file_filter_func=None, callback_func=None,
                                      thread_wise_objs=None,
                                      thread_init_func=None, thread_end_func=None,
                                      file_encoding='utf-8', thread_end_args=[]):
-    num_tasks = 1000
-    pdf_queque = multiprocessing.JoinableQueue(num_tasks)
-    thread_num = min(num_tasks, num_procs)
-    arr = [process_func] if args is None else [process_func] + args
-    arr.insert(0, pdf_queque)
-    thread_objs = []
-    for i in range(thread_num):
-        tarr = arr[:]
-        thread_obj = None
-        if thread_wise_objs is not None and isinstance(thread_wise_objs, list):
-            thread_obj = thread_wise_objs[i]
-        if thread_obj is None and thread_init_func is not None:
-            thread_obj = thread_init_func()
-            thread_objs.append(thread_obj)
-        tarr.insert(0, thread_obj)
-        p = multiprocessing.Process(target=multi_process_do, args=tuple(tarr))
-        p.start()
-
-    num_lines = 0
-    with codecs.open(large_file, encoding=file_encoding) as lf:
-        for line in lf:
-            num_lines += 1
-            pdf_queque.put(line)
-    for i in range(thread_num):
-        pdf_queque.put('EMPTY-NOW')
-    pdf_queque.join()
-    if thread_end_func is not None:
-        for to in thread_objs:
-            if to is not None:
-                thread_end_func(to, *tuple(thread_end_args))
+    if num_procs is None:
+        num_procs = available_cpus()
+    _run_tasks('process', _read_lines(large_file, file_encoding), num_procs, process_func, args=args,
+               thread_wise_objs=thread_wise_objs, thread_init_func=thread_init_func,
+               thread_end_func=thread_end_func, thread_end_args=thread_end_args)
     if callback_func is not None:
         callback_func(*tuple(args))
 
 
+def multi_process_pool_tasking(lst, process_func, num_procs=None, chunk_size=20,
+                               init_func=None, init_args=(), done_func=None):
+    """
+    process a list in a process pool, distributing the items in chunks
+    :param lst: the items
+    :param process_func: a module level function called with each item in the workers
+    :param num_procs: number of worker processes, defaults to the number of CPUs available
+    :param chunk_size: number of items per task sent to a worker
+    :param init_func: module level function called once in each worker, e.g., to load models
+    :param init_args: arguments of init_func
+    :param done_func: called in this process with each item processed without errors
+    :return: per worker stats, a dict of pid to {'done': n, 'errors': n, 'seconds': t}
+    """
+    if len(lst) == 0:
+        return {}
+    if num_procs is None:
+        num_procs = available_cpus()
+    with TaskExecutor(num_workers=min(num_procs, (len(lst) + chunk_size - 1) // chunk_size), mode='process',
+                      chunk_size=chunk_size, init_func=init_func, init_args=init_args) as executor:
+        return executor.run(process_func, lst, done_func=done_func)
+
+
+def file_line_chunks(file_path, chunk_bytes):
+    """
+    split a (large) text file into chunks of whole lines
+    :param file_path:
+    :param chunk_bytes: approximate chunk size in bytes
+    :return: generator of (start, end) byte offsets
+    """
+    size = os.path.getsize(file_path)
+    with open(file_path, 'rb') as f:
+        start = 0
+        while start < size:
+            f.seek(min(start + chunk_bytes, size))
+            # move on to the end of the current line
+            f.readline()
+            end = min(f.tell(), size)
+            yield start, end
+            start = end
+
+
+def read_file_chunk(file_path, start, end):
+    with open(file_path, 'rb') as f:
+        f.seek(start)
+        return f.read(end - start)
+
+
+def _process_file_chunk(process_func, large_file, offsets):
+    return process_func(large_file, *offsets)
+
+
+def multi_process_file_chunks(large_file, process_func, result_func, num_procs=None,
+                              chunk_bytes=8 * 1024 * 1024, max_pending=None, init_func=None, init_args=(),
+                              chunk_filter_func=None):
+    """
+    process a large line based file by chunks in a process pool and hand the results over in file order,
+    at most max_pending chunks are in flight so memory use is bounded whatever the file size
+    :param large_file:
+    :param process_func: module level function called as process_func(large_file, start, end) in the workers
+    :param result_func: called in this process with the result of each chunk, in file order
+    :param num_procs: number of worker processes, defaults to the number of CPUs available
+    :param chunk_bytes: approximate chunk size in bytes
+    :param max_pending: maximum number of chunks in flight, default twice the number of workers
+    :param init_func: module level function called once in each worker
+    :param init_args: arguments of init_func
+    :param chunk_filter_func: called with (start, end) of each chunk, the chunk is skipped if it returns False
+    :return: number of chunks processed
+    """
+    chunks = (c for c in file_line_chunks(large_file, chunk_bytes)
+              if chunk_filter_func is None or chunk_filter_func(*c))
+    num_chunks = 0
+    with TaskExecutor(num_workers=num_procs, mode='process', max_pending=max_pending,
+                      init_func=init_func, init_args=init_args) as executor:
+        for r in executor.map(partial(_process_file_chunk, process_func, large_file), chunks):
+            if r.error is not None:
+                raise r.error
+            result_func(r.result)
+            num_chunks += 1
+    return num_chunks
+
+
 if __name__ == "__main__":
     pass
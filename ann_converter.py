@@ -92,6 +92,7 @@ class AnnConverter(object):
             anns += ann_doc.annotations
         if 'phenotypes' in ann_to_convert:
             anns += ann_doc.phenotypes
+        relocator = ann_post_rules.AnnotationRelocator(full_text) if full_text is not None else None
         for ann in sorted(anns, key=lambda x: x.start): # was just anns
             if sty_filters is not None:
                 if not hasattr(ann, 'sty') or ann.sty not in sty_filters:
@@ -119,8 +120,7 @@ class AnnConverter(object):
                 if full_text[s:e].lower() != ann.str.lower():
                     os = s
                     oe = e
-                    [s, e] = ann_post_rules.AnnRuleExecutor.relocate_annotation_pos(full_text,
-                                                                                    s, e, ann.str)
+                    [s, e] = relocator.relocate(s, e, ann.str)
                     logging.info('%s,%s => %s,%s' % (os, oe, s, e))
                 # else:
                 #    logging.info('string matches, no reloaction needed [%s] [%s]' % (full_text[s:e].lower(), ann.str.lower()))
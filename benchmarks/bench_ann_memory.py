@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+# Measure the memory held per annotation by a loaded SemEHRAnnDoc (slotted annotation objects).
+#
+# Usage: bench_ann_memory.py [NUM_SENTENCES]
+# e.g. python3 benchmarks/bench_ann_memory.py 20000
+
+import gc
+import json
+import sys
+import tracemalloc
+from os.path import abspath, dirname, join
+
+sys.path.insert(0, abspath(join(dirname(__file__), '..')))
+from benchmarks.synthetic_docs import make_gate_doc
+from SemEHR.docanalysis import SemEHRAnnDoc
+
+
+def allocated(func):
+    """bytes still allocated after calling func, together with its result"""
+    gc.collect()
+    tracemalloc.start()
+    ret = func()
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return size, ret
+
+
+def load_doc(json_doc):
+    ann_doc = SemEHRAnnDoc()
+    ann_doc.load(json_doc, file_key='bench')
+    # keep the annotations only, the json doc is not part of the measurement
+    ann_doc._doc = None
+    return ann_doc
+
+
+if __name__ == '__main__':
+    num_sents = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    doc, text = make_gate_doc(num_sents)
+    # a json round trip, so that strings are not shared literals of the generator
+    json_doc = json.loads(json.dumps(doc))
+    doc_size, ann_doc = allocated(lambda: load_doc(json_doc))
+    num_anns = len(ann_doc.annotations) + len(ann_doc.phenotypes) + len(ann_doc.sentences)
+    print('SemEHRAnnDoc      %8.1f bytes per annotation (%s annotations)' % (doc_size / num_anns, num_anns))
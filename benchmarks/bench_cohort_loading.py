@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# Compare loading a full SemEHRAnnDoc (as cohort collection used to) against the projection
+# loader iter_doc_anns, parsing in one go or incrementally with ijson (when installed).
+# Reports wall-clock time over many small docs and the peak memory of one large doc.
+#
+# Usage: bench_cohort_loading.py [NUM_DOCS] [LARGE_DOC_SENTENCES]
+# e.g. python3 benchmarks/bench_cohort_loading.py 500 50000
+
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+import tracemalloc
+from os.path import abspath, dirname, join
+
+sys.path.insert(0, abspath(join(dirname(__file__), '..')))
+from benchmarks.synthetic_docs import make_gate_doc
+import SemEHR.docanalysis as docanalysis
+import SemEHR.utils as utils
+
+
+def save_ruled_doc(num_sents, file_path, seed=0):
+    doc, text = make_gate_doc(num_sents, seed=seed)
+    ann_doc = docanalysis.SemEHRAnnDoc()
+    ann_doc.load(doc, file_key='bench')
+    utils.save_json_array(ann_doc.serialise_json(), file_path)
+
+
+def load_full(doc_path):
+    ann_doc = docanalysis.SemEHRAnnDoc()
+    ann_doc.load(utils.load_json_data(doc_path))
+    return [{'cui': a.cui, 'pref': a.pref, 'sty': a.sty, 'negation': a.negation,
+             'experiencer': a.experiencer, 'ruled_by': a.ruled_by} for a in ann_doc.annotations]
+
+
+def load_projection(doc_path):
+    return list(docanalysis.iter_doc_anns(doc_path, docanalysis._cohort_ann_fields,
+                                          incremental_min_bytes=float('inf')))
+
+
+def load_incremental(doc_path):
+    return list(docanalysis.iter_doc_anns(doc_path, docanalysis._cohort_ann_fields, incremental_min_bytes=0))
+
+
+def peak_memory(func, doc_path):
+    tracemalloc.start()
+    func(doc_path)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+if __name__ == '__main__':
+    num_docs = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    large_sents = int(sys.argv[2]) if len(sys.argv) > 2 else 50000
+    tmp_dir = tempfile.mkdtemp()
+    docs = [join(tmp_dir, '%s.json' % i) for i in range(num_docs)]
+    for i, d in enumerate(docs):
+        save_ruled_doc(60, d, seed=i)
+    large_doc = join(tmp_dir, 'large.json')
+    save_ruled_doc(large_sents, large_doc)
+    print('%s docs of %.0f KB, a large doc of %.1f MB, json backend %s, ijson %s' %
+          (num_docs, os.path.getsize(docs[0]) / 1e3, os.path.getsize(large_doc) / 1e6, utils.get_json_backend(),
+           'not installed' if docanalysis.ijson is None else docanalysis.ijson.backend))
+    loaders = [('full SemEHRAnnDoc', load_full), ('projection', load_projection)]
+    if docanalysis.ijson is not None:
+        loaders.append(('incremental', load_incremental))
+    results = {}
+    for name, func in loaders:
+        results[name] = [func(d) for d in docs + [large_doc]]
+        t = min(timeit.repeat(lambda: [func(d) for d in docs], number=1, repeat=3))
+        print('%-18s %7.3f s for the small docs, peak %7.1f MB for the large doc' %
+              (name, t, peak_memory(func, large_doc) / 1e6))
+    print('same results: %s' % all(r == results['full SemEHRAnnDoc'] for r in results.values()))
+    shutil.rmtree(tmp_dir)
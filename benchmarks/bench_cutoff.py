@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# Compare per-annotation cut-off matching (lower casing the full text for every anchor
+# of every annotation) against the per-document anchor positions of AnnRuleExecutor.
+#
+# Usage: bench_cutoff.py [DOC_SIZE] [NUM_MENTIONS] [CUTOFF_RULES]
+# e.g. python3 benchmarks/bench_cutoff.py 50000 200 ./studies/rules/cris_cutoff_filters.json
+
+import os
+import random
+import sys
+import timeit
+from os.path import abspath, dirname, join
+
+root = abspath(join(dirname(__file__), '..'))
+sys.path.insert(0, root)
+from SemEHR.ann_post_rules import AnnRuleExecutor
+import SemEHR.utils as utils
+
+
+def make_text(size, anchor, seed=0):
+    """a document of random words with the anchor text in the middle"""
+    rnd = random.Random(seed)
+    words = ['patient', 'seen', 'in', 'clinic', 'with', 'diabetes', 'no', 'evidence', 'of', 'asthma']
+    tokens = []
+    while sum(len(t) + 1 for t in tokens) < size / 2:
+        tokens.append(rnd.choice(words))
+    tokens.append(anchor)
+    while sum(len(t) + 1 for t in tokens) < size:
+        tokens.append(rnd.choice(words))
+    return ' '.join(tokens)
+
+
+def legacy_cut_off_matching(text, anchor_texts, check_pos):
+    """cut_off_matching before the per-document precomputation"""
+    for t in anchor_texts:
+        pos = text.lower().find(t.lower())
+        if check_pos >= pos > 0:
+            return True
+    return False
+
+
+def run_legacy(ruler, text, positions):
+    return [any(legacy_cut_off_matching(text, r.reg_patterns, p)
+                for r in ruler._filter_rules if r.compare_type == -100) for p in positions]
+
+
+def run_per_document(ruler, text, positions):
+    cut_offs = ruler.get_cut_off_positions(text)
+    return [any(pos is not None and p >= pos for pos in cut_offs.values()) for p in positions]
+
+
+if __name__ == '__main__':
+    doc_size = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    num_mentions = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    os.chdir(root)
+    rules = utils.load_json_data(sys.argv[3] if len(sys.argv) > 3 else './studies/rules/cris_cutoff_filters.json')
+    ruler = AnnRuleExecutor()
+    for r in rules:
+        ruler.add_filter_rule(r['offset'], r['regs'], rule_name='cutoff', containing_pattern=True)
+    text = make_text(doc_size, rules[0]['regs'][0])
+    positions = sorted(random.Random(1).randint(0, len(text)) for i in range(num_mentions))
+    results = {}
+    for name, func in [('per-annotation', run_legacy), ('per-document', run_per_document)]:
+        results[name] = func(ruler, text, positions)
+        t = min(timeit.repeat(lambda: func(ruler, text, positions), number=1, repeat=5))
+        print('%-16s %8.4f s for %s mentions on a %s character document' % (name, t, num_mentions, len(text)))
+    print('same results: %s' % (results['per-annotation'] == results['per-document']))
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+# Compare the json backends of SemEHR.utils (orjson, ujson, stdlib json - whichever are installed)
+# on loading a synthetic GATE annotation file, serialising the analysed SemEHRAnnDoc and saving it.
+#
+# Usage: bench_json.py [NUM_SENTENCES] [REPEATS]
+# e.g. python3 benchmarks/bench_json.py 5000
+
+import os
+import sys
+import tempfile
+import timeit
+from os.path import abspath, dirname, join
+
+sys.path.insert(0, abspath(join(dirname(__file__), '..')))
+from benchmarks.synthetic_docs import make_gate_doc
+from SemEHR.docanalysis import SemEHRAnnDoc
+import SemEHR.utils as utils
+
+
+def best_of(func, repeats):
+    return min(timeit.repeat(func, number=1, repeat=repeats))
+
+
+if __name__ == '__main__':
+    num_sents = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    doc, text = make_gate_doc(num_sents)
+    tmp_dir = tempfile.mkdtemp()
+    ann_file = join(tmp_dir, 'anns.json')
+    out_file = join(tmp_dir, 'se_ann_bench.json')
+    utils.set_json_backend('json')
+    utils.save_json_array(doc, ann_file)
+    ann_mb = os.path.getsize(ann_file) / 1e6
+    ann_doc = SemEHRAnnDoc()
+    ann_doc.load(doc, file_key='bench')
+    ruled = ann_doc.serialise_json()
+    print('synthetic doc: %s annotations, %.1f MB' % (len(doc['annotations'][0]), ann_mb))
+    results = {}
+    for name in utils.json_backends():
+        utils.set_json_backend(name)
+        t_load = best_of(lambda: utils.load_json_data(ann_file), repeats)
+        t_ser = best_of(lambda: utils.json_dumps(ann_doc.serialise_json()), repeats)
+        t_save = best_of(lambda: utils.save_json_array(ruled, out_file), repeats)
+        out_mb = os.path.getsize(out_file) / 1e6
+        results[name] = (utils.load_json_data(ann_file), utils.load_json_data(out_file))
+        print('%-8s load %7.1f MB/s  serialise %7.1f MB/s  save %7.1f MB/s' %
+              (name, ann_mb / t_load, out_mb / t_ser, out_mb / t_save))
+    print('same results: %s' % all(r == results['json'] for r in results.values()))
+    for f in [ann_file, out_file]:
+        os.unlink(f)
+    os.rmdir(tmp_dir)
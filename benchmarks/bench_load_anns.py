@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# Compare SemEHRAnnDoc.load_anns against the previous loader (which re-sorted
+# the sentence list after every Sentence annotation) on a synthetic document.
+#
+# Usage: bench_load_anns.py [NUM_SENTENCES] [REPEATS]
+# e.g. python3 benchmarks/bench_load_anns.py 5000
+
+import sys
+import timeit
+from os.path import abspath, dirname, join
+
+sys.path.insert(0, abspath(join(dirname(__file__), '..')))
+from benchmarks.synthetic_docs import make_gate_doc
+from SemEHR.docanalysis import SemEHRAnnDoc, SemEHRAnn, PhenotypeAnn, BasicAnn
+
+
+def legacy_load_anns(ann_doc, json_doc):
+    """the GATE/Bio-YODIE branch of SemEHRAnnDoc.load_anns before the single-pass loader"""
+    all_anns = ann_doc._anns
+    panns = ann_doc._phenotype_anns
+    for anns in json_doc['annotations']:
+        for ann in anns:
+            t = ann['type']
+            if t == 'Mention':
+                a = SemEHRAnn(ann['features']['string_orig'],
+                              int(ann['startNode']['offset']), int(ann['endNode']['offset']),
+                              ann['features']['Negation'], ann['features']['Temporality'],
+                              ann['features']['Experiencer'],
+                              ann['features']['inst'], ann['features']['STY'], ann['features']['PREF'], t)
+                all_anns.append(a)
+                a.id = 'cui-%s' % len(all_anns)
+            elif t == 'Phenotype':
+                a = PhenotypeAnn(ann['features']['string_orig'],
+                                 int(ann['startNode']['offset']), int(ann['endNode']['offset']),
+                                 ann['features']['Negation'], ann['features']['Temporality'],
+                                 ann['features']['Experiencer'],
+                                 ann['features']['majorType'], ann['features']['minorType'])
+                panns.append(a)
+                a.id = 'phe-%s' % len(panns)
+            elif t == 'Sentence':
+                a = BasicAnn('Sentence', int(ann['startNode']['offset']), int(ann['endNode']['offset']))
+                ann_doc._sentences.append(a)
+                ann_doc._sentences = sorted(ann_doc._sentences, key=lambda x: x.start)
+                a.id = 'sent-%s' % len(ann_doc._sentences)
+            else:
+                ann_doc._others.append(ann)
+    sorted(all_anns, key=lambda x: x.start)
+
+
+def run_legacy(json_doc):
+    legacy_load_anns(SemEHRAnnDoc(), json_doc)
+
+
+def run_current(json_doc):
+    SemEHRAnnDoc().load(json_doc, file_key='bench')
+
+
+if __name__ == '__main__':
+    num_sents = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    doc, text = make_gate_doc(num_sents)
+    print('synthetic doc: %s annotations, %s characters' % (len(doc['annotations'][0]), len(text)))
+    for name, func in [('legacy loader', run_legacy), ('single-pass loader', run_current)]:
+        t = min(timeit.repeat(lambda: func(doc), number=1, repeat=repeats))
+        print('%-20s %8.3f s' % (name, t))
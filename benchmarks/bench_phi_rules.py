@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# Compare ExtractRule.do_full_text_parsing, which runs the PHI rules of the anonymisation rule group
+# compiled once at load, against compiling the rules for each report (rul_extraction).
+# Reports are synthetic: the lines of the sample report shuffled into synthetic clinical text.
+#
+# Usage: bench_phi_rules.py [NUM_REPORTS] [RULE_GROUP]
+# e.g. python3 benchmarks/bench_phi_rules.py 500 PHI_rules
+
+import random
+import re
+import sys
+import timeit
+from os import listdir
+from os.path import abspath, dirname, join
+
+root = abspath(join(dirname(__file__), '..'))
+sys.path.insert(0, root)
+from benchmarks.synthetic_docs import make_gate_doc
+from SemEHR.rule_extractor import ExtractRule
+import SemEHR.utils as utils
+
+rules_folder = join(root, 'anonymisation', 'conf', 'rules')
+sample_report = join(root, 'anonymisation', 'test_data', 'doc1.txt')
+# case variants of letters matched by case insensitive patterns (e.g. the kelvin sign for k)
+case_variants = {'k': 'K', 's': 'ſ', 'i': 'İ'}
+
+
+def make_report(sample_lines, seed):
+    rnd = random.Random(seed)
+    doc, text = make_gate_doc(20, seed=seed)
+    lines = text.split('\n') + rnd.sample(sample_lines, rnd.randint(0, len(sample_lines)))
+    rnd.shuffle(lines)
+    report = '\n'.join(lines)
+    if seed % 3 == 0:
+        report = report.upper()
+    if seed % 5 == 0:
+        report = ''.join(case_variants.get(c, c) if rnd.random() < 0.3 else c for c in report)
+    return report
+
+
+def run_per_report(ruler, reports, rule_group):
+    group = ruler._rules[rule_group]
+    return [[m for st in group for m in ExtractRule.rul_extraction(r, group[st] if type(group[st]) is list
+                                                                   else [group[st]])]
+            for r in reports]
+
+
+def run_compiled(ruler, reports, rule_group):
+    return [ruler.do_full_text_parsing(r, rule_group=rule_group)[0] for r in reports]
+
+
+if __name__ == '__main__':
+    num_reports = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    rule_group = sys.argv[2] if len(sys.argv) > 2 else 'PHI_rules'
+    ruler = ExtractRule([join(rules_folder, f) for f in listdir(rules_folder) if re.match(r'.*_rules.json$', f)])
+    sample_lines = utils.read_text_file(sample_report)
+    reports = [make_report(sample_lines, i) for i in range(num_reports)]
+    print('%s reports, %s rules' % (num_reports, sum(len(rules) for st, rules in ruler._compiled[rule_group])))
+    results = {}
+    for name, func in [('per report', run_per_report), ('compiled', run_compiled)]:
+        results[name] = func(ruler, reports, rule_group)
+        t = min(timeit.repeat(lambda: func(ruler, reports, rule_group), number=1, repeat=3))
+        print('%-12s %7.3f s' % (name, t))
+    print('same results: %s' % (results['per report'] == results['compiled']))
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# Compare finding and Q-masking the sensitive phrases of a report one phrase at a time (as
+# wrap_anonymise_doc_by_file used to) against the single scan of PhraseMatcher.
+# Reports are synthetic clinical text with the phrases scattered in it.
+#
+# Usage: bench_phrase_redaction.py [NUM_SENTENCES] [NUM_PHRASES] [REPEATS]
+# e.g. python3 benchmarks/bench_phrase_redaction.py 2000 60
+
+import random
+import re
+import sys
+import timeit
+from os.path import abspath, dirname, join
+
+sys.path.insert(0, abspath(join(dirname(__file__), '..')))
+from benchmarks.synthetic_docs import make_gate_doc
+from SemEHR.anonymiser import PhraseMatcher
+
+
+def make_phrases(num_phrases, seed=0):
+    rnd = random.Random(seed)
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    phrases = []
+    for i in range(num_phrases):
+        name = ' '.join(''.join(rnd.choice(letters) for _ in range(rnd.randint(4, 9))).capitalize()
+                        for _ in range(rnd.randint(1, 3)))
+        phrases.append(name)
+        # the sensitive words of a phrase, as wrap_anonymise_doc_by_file adds them
+        phrases += ['\\b' + w + '\\b' for w in name.split(' ') if len(w) > 3]
+    return phrases
+
+
+def make_report(num_sents, phrases, seed=0):
+    rnd = random.Random(seed)
+    doc, text = make_gate_doc(num_sents, seed=seed)
+    words = text.split(' ')
+    for i in range(len(words) // 20):
+        words.insert(rnd.randint(0, len(words)), rnd.choice(phrases).replace('\\b', '').upper())
+    return ' '.join(words)
+
+
+def one_by_one(phrases, text):
+    found = []
+    for v in phrases:
+        ptn = re.compile(re.escape(v), re.IGNORECASE)
+        found += [(m.span()[0], m.group(0)) for m in re.finditer(ptn, text)]
+    for v in phrases:
+        ptn = re.compile(re.escape(v), re.IGNORECASE)
+        text = ptn.sub('Q' * len(v), text)
+    return found, text
+
+
+def single_scan(phrases, text):
+    matcher = PhraseMatcher(phrases, text)
+    return matcher.matches(), matcher.redact('Q')
+
+
+if __name__ == '__main__':
+    num_sents = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    num_phrases = int(sys.argv[2]) if len(sys.argv) > 2 else 60
+    repeats = int(sys.argv[3]) if len(sys.argv) > 3 else 3
+    phrases = make_phrases(num_phrases)
+    text = make_report(num_sents, phrases)
+    print('report of %s chars, %s phrases and words' % (len(text), len(phrases)))
+    results = {}
+    for name, func in [('one by one', one_by_one), ('single scan', single_scan)]:
+        results[name] = func(phrases, text)
+        t = min(timeit.repeat(lambda: func(phrases, text), number=1, repeat=repeats))
+        print('%-12s %7.3f s' % (name, t))
+    print('same results: %s' % (results['one by one'] == results['single scan']))
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# Compare reading each ann doc and full text in the worker (as analyse_doc_anns_file does) against
+# DocPrefetcher reading them ahead with I/O threads, with a simulated storage latency per full text.
+#
+# Usage: bench_prefetch.py [NUM_DOCS] [LATENCY_MS] [WORKER_THREADS]
+# e.g. python3 benchmarks/bench_prefetch.py 200 20 2
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+from os.path import abspath, dirname, join
+
+root = abspath(join(dirname(__file__), '..'))
+sys.path.insert(0, root)
+from benchmarks.synthetic_docs import make_gate_doc
+import SemEHR.docanalysis as docanalysis
+import SemEHR.utils as utils
+
+
+class SlowTextReader(docanalysis.FileTextReader):
+    """a file text reader on slow (e.g. network) storage"""
+
+    def __init__(self, folder, pattern, latency):
+        super().__init__(folder, pattern)
+        self._latency = latency
+
+    def read_full_text(self, fk):
+        time.sleep(self._latency)
+        return super().read_full_text(fk)
+
+
+def run_in_worker(ann_files, ruler, reader, num_threads):
+    utils.multi_thread_tasking(ann_files, num_threads, docanalysis.analyse_doc_anns_file,
+                               args=[ruler, reader, None])
+
+
+def run_prefetched(ann_files, ruler, reader, num_threads):
+    prefetcher = docanalysis.DocPrefetcher(ann_files, reader, prefetch=32, io_threads=8)
+    utils.multi_thread_tasking_it(prefetcher, num_threads, docanalysis.analyse_prefetched_doc,
+                                  args=[prefetcher, ruler, None])
+    return prefetcher.stats
+
+
+if __name__ == '__main__':
+    num_docs = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    latency = (float(sys.argv[2]) if len(sys.argv) > 2 else 20) / 1000
+    num_threads = int(sys.argv[3]) if len(sys.argv) > 3 else 2
+    os.chdir(root)
+    tmp_dir = tempfile.mkdtemp()
+    ann_files = []
+    for i in range(num_docs):
+        doc, text = make_gate_doc(40, seed=i)
+        utils.save_json_array(doc, join(tmp_dir, 'd%s.json' % i))
+        utils.save_string(text, join(tmp_dir, 'd%s.txt' % i))
+        ann_files.append(join(tmp_dir, 'd%s.json' % i))
+    ruler = docanalysis.load_study_ruler(None, None)['ruler']
+    reader = SlowTextReader(tmp_dir, '%s.txt', latency)
+    t = time.time()
+    run_in_worker(ann_files, ruler, reader, num_threads)
+    print('read in workers   %7.2f s' % (time.time() - t))
+    t = time.time()
+    stats = run_prefetched(ann_files, ruler, reader, num_threads)
+    print('prefetched        %7.2f s (I/O %.2f s, I/O wait %.2f s, processing %.2f s)' %
+          (time.time() - t, stats['io_seconds'], stats['io_wait_seconds'], stats['process_seconds']))
+    shutil.rmtree(tmp_dir)
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+# Compare the compiled and the rule-by-rule modes of AnnRuleExecutor.execute_context_text
+# on the contexts of a synthetic document, using the default rule config.
+#
+# Usage: bench_rule_engine.py [NUM_SENTENCES] [RULE_CONFIG]
+# e.g. python3 benchmarks/bench_rule_engine.py 2000 ./studies/rules/_default_rule_config.json
+
+import os
+import sys
+import timeit
+from os.path import abspath, dirname, join
+
+root = abspath(join(dirname(__file__), '..'))
+sys.path.insert(0, root)
+from benchmarks.synthetic_docs import make_gate_doc
+from SemEHR.ann_post_rules import AnnRuleExecutor
+import SemEHR.docanalysis as docanalysis
+
+
+def collect_contexts(ruler, ann_doc, text):
+    """run process_doc_rule once and record the arguments of every execute_context_text call"""
+    calls = []
+    execute = ruler.execute_context_text
+
+    def recording_execute(*args, **kwargs):
+        calls.append((args, kwargs))
+        return execute(*args, **kwargs)
+
+    ruler.execute_context_text = recording_execute
+    docanalysis.process_doc_rule(ann_doc, ruler, docanalysis.WrapperTextReader(text), None, None)
+    del ruler.execute_context_text
+    return calls
+
+
+def synthetic_contexts(ruler, num_sents):
+    doc, text = make_gate_doc(num_sents)
+    ann_doc = docanalysis.SemEHRAnnDoc()
+    ann_doc.load(doc, file_key='bench')
+    return collect_contexts(ruler, ann_doc, text)
+
+
+def run(ruler, calls):
+    return [ruler.execute_context_text(*args, **kwargs) for args, kwargs in calls]
+
+
+if __name__ == '__main__':
+    num_sents = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    os.chdir(root)
+    ruler = AnnRuleExecutor()
+    ruler.load_rule_config(sys.argv[2] if len(sys.argv) > 2 else './studies/rules/_default_rule_config.json')
+    calls = synthetic_contexts(ruler, num_sents)
+    results = {}
+    for compiled in [False, True]:
+        ruler.compiled = compiled
+        results[compiled] = run(ruler, calls)
+        t = min(timeit.repeat(lambda: run(ruler, calls), number=1, repeat=3))
+        print('%-12s %8.3f s for %s annotations (%.1f us per annotation)' %
+              ('compiled' if compiled else 'rule-by-rule', t, len(calls), t * 1e6 / max(len(calls), 1)))
+    print('same results: %s' % (results[False] == results[True]))
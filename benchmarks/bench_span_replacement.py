@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+# Compare replacing the PHI spans of a report one do_replace call at a time (as anonymise_doc
+# used to) against ExtractRule.do_replace_all, on synthetic clinical text with many hits.
+#
+# Usage: bench_span_replacement.py [NUM_SENTENCES] [NUM_SPANS]
+# e.g. python3 benchmarks/bench_span_replacement.py 5000 5000
+
+import random
+import sys
+import timeit
+from os.path import abspath, dirname, join
+
+sys.path.insert(0, abspath(join(dirname(__file__), '..')))
+from benchmarks.synthetic_docs import make_gate_doc
+from SemEHR.rule_extractor import ExtractRule
+
+
+def one_by_one(text, replacements):
+    for pos, sent_text in replacements:
+        text = ExtractRule.do_replace(text, pos, sent_text)
+    return text
+
+
+if __name__ == '__main__':
+    num_sents = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    num_spans = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+    doc, text = make_gate_doc(num_sents)
+    rnd = random.Random(0)
+    replacements = []
+    for i in range(num_spans):
+        pos = rnd.randint(0, len(text) - 30)
+        replacements.append((pos, text[pos:pos + rnd.randint(2, 30)]))
+    print('report of %s chars, %s spans' % (len(text), num_spans))
+    results = {}
+    for name, func in [('one by one', one_by_one), ('in one pass', ExtractRule.do_replace_all)]:
+        results[name] = func(text, replacements)
+        t = min(timeit.repeat(lambda: func(text, replacements), number=1, repeat=3))
+        print('%-12s %7.3f s' % (name, t))
+    print('same results: %s' % (results['one by one'] == results['in one pass']))
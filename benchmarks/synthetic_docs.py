@@ -0,0 +1,55 @@
+"""
+synthetic Bio-YODIE/GATE annotation documents for the benchmark scripts in this folder
+"""
+import random
+
+_words = ['patient', 'was', 'seen', 'in', 'clinic', 'today', 'with', 'and', 'the', 'no', 'evidence', 'of',
+          'family', 'history', 'mother', 'had', 'denies', 'possible', 'never', 'ruled', 'out', 'for',
+          'review', 'negative', 'if', 'risk', 'screening', 'referral', 'follow', 'up', 'letter', 'plan']
+_mentions = [('diabetes', 'C0011849', 'Disease or Syndrome'),
+             ('asthma', 'C0004096', 'Disease or Syndrome'),
+             ('hepatitis c', 'C0019196', 'Disease or Syndrome'),
+             ('depression', 'C0011570', 'Mental or Behavioral Dysfunction'),
+             ('cancer', 'C0006826', 'Neoplastic Process'),
+             ('pain', 'C0030193', 'Sign or Symptom')]
+_sent_ends = ['.', '.', '.', '?']
+
+
+def _gate_ann(ann_type, start, end, features):
+    return {'type': ann_type, 'startNode': {'offset': start}, 'endNode': {'offset': end}, 'features': features}
+
+
+def make_gate_doc(num_sentences, mention_rate=0.2, seed=0):
+    """
+    generate a full text and its (shuffled) GATE annotation json
+    :param num_sentences: number of Sentence annotations
+    :param mention_rate: probability of a token being a concept mention
+    :param seed: random seed
+    :return: (annotation json, full text)
+    """
+    rnd = random.Random(seed)
+    text = ''
+    anns = []
+    for i in range(num_sentences):
+        s_start = len(text)
+        tokens = []
+        for j in range(rnd.randint(4, 20)):
+            pos = s_start + sum(len(tk) + 1 for tk in tokens)
+            if rnd.random() < mention_rate:
+                m = rnd.choice(_mentions)
+                tokens.append(m[0])
+                anns.append(_gate_ann('Mention', pos, pos + len(m[0]),
+                                      {'string_orig': m[0], 'Negation': rnd.choice(['Affirmed', 'Negated']),
+                                       'Temporality': 'Recent', 'Experiencer': rnd.choice(['Patient', 'Other']),
+                                       'inst': m[1], 'STY': m[2], 'PREF': m[0].title()}))
+                if rnd.random() < 0.1:
+                    anns.append(_gate_ann('Phenotype', pos, pos + len(m[0]),
+                                          {'string_orig': m[0], 'Negation': 'Affirmed', 'Temporality': 'Recent',
+                                           'Experiencer': 'Patient', 'majorType': 'phenotype', 'minorType': m[0]}))
+            else:
+                tokens.append(rnd.choice(_words))
+        sent = ' '.join(tokens) + rnd.choice(_sent_ends)
+        text += sent + ' '
+        anns.append(_gate_ann('Sentence', s_start, s_start + len(sent), {}))
+    rnd.shuffle(anns)
+    return {'annotations': [anns]}, text
@@ -0,0 +1,78 @@
+import os
+import unittest
+from os.path import abspath, dirname, join
+
+from benchmarks.bench_rule_engine import collect_contexts
+from benchmarks.synthetic_docs import make_gate_doc
+from SemEHR.ann_post_rules import AnnRuleExecutor
+import SemEHR.docanalysis as docanalysis
+
+root = abspath(join(dirname(__file__), '..'))
+
+# contexts hitting the shipped negation, hypothetical, experiencer and document filters
+hand_made_sents = [
+    'Patient denies any history of depression.',
+    'There is no evidence of psychosis at this stage.',
+    'He has never had suicidal thoughts; mood is fine.',
+    'Psychosis was ruled out last year.',
+    'If she becomes depressed, please contact the team.',
+    'His mother has a history of schizophrenia.',
+    'Family history: father with bipolar disorder.',
+    'Risk of self harm - negative.',
+    'She does not have any symptoms of anxiety.',
+    'Non-compliant with medication, history of psychosis.',
+]
+
+
+class CompiledRuleTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cwd = os.getcwd()
+        # the rule config uses paths relative to the repo root
+        os.chdir(root)
+        try:
+            cls.ruler = AnnRuleExecutor()
+            cls.ruler.load_rule_config('./studies/rules/_default_rule_config.json')
+        finally:
+            os.chdir(cwd)
+
+    def assert_same_results(self, calls):
+        results = {}
+        for compiled in [False, True]:
+            self.ruler.compiled = compiled
+            results[compiled] = [self.ruler.execute_context_text(*args, **kwargs) for args, kwargs in calls]
+        self.ruler.compiled = True
+        self.assertEqual(results[False], results[True])
+        return results[False]
+
+    def test_synthetic_doc(self):
+        doc, text = make_gate_doc(300)
+        ann_doc = docanalysis.SemEHRAnnDoc()
+        ann_doc.load(doc, file_key='test')
+        calls = collect_contexts(self.ruler, ann_doc, text)
+        self.assertTrue(len(calls) > 0)
+        self.assert_same_results(calls)
+
+    def test_hand_made_contexts(self):
+        calls = []
+        text = ' '.join(hand_made_sents)
+        for term in ['depression', 'psychosis', 'suicidal', 'depressed', 'schizophrenia',
+                     'bipolar disorder', 'self harm', 'anxiety']:
+            start = text.find(term)
+            end = start + len(term)
+            for sent in hand_made_sents:
+                if term in sent:
+                    s = sent.find(term)
+                    calls.append(((text, sent[:s], sent[s + len(term):], term, start, end), {}))
+                    calls.append(((text, sent[:s], sent[s + len(term):], term, start, end),
+                                  {'more_context_sents': {'prev': hand_made_sents[0],
+                                                          'next': hand_made_sents[-1]}}))
+        results = self.assert_same_results(calls)
+        # the shipped rules filter out at least some of these
+        self.assertTrue(any(r[0] for r in results))
+        self.assertTrue(not all(r[0] for r in results))
+
+
+if __name__ == '__main__':
+    unittest.main()
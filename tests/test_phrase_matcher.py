@@ -0,0 +1,91 @@
+import random
+import re
+import unittest
+
+from SemEHR.anonymiser import PhraseMatcher
+
+
+def one_by_one(phrases, text, repl_char='Q'):
+    """find and replace the phrases one after another, as wrap_anonymise_doc_by_file used to"""
+    found = []
+    for v in phrases:
+        found += [(m.start(), m.group(0)) for m in re.finditer(re.compile(re.escape(v), re.IGNORECASE), text)]
+    for v in phrases:
+        text = re.compile(re.escape(v), re.IGNORECASE).sub(repl_char * len(v), text)
+    return found, text
+
+
+def single_scan(phrases, text, repl_char='Q'):
+    matcher = PhraseMatcher(phrases, text)
+    return matcher.matches(), matcher.redact(repl_char)
+
+
+class PhraseMatcherTest(unittest.TestCase):
+
+    def assert_same(self, phrases, text):
+        self.assertEqual(one_by_one(phrases, text), single_scan(phrases, text))
+
+    def test_simple(self):
+        phrases = ['John Smith', 'John', 'Smith']
+        text = 'JOHN SMITH was seen by john smith jr. and Mr Smithers.'
+        self.assert_same(phrases, text)
+        found, redacted = single_scan(phrases, text)
+        self.assertEqual(found[:2], [(0, 'JOHN SMITH'), (23, 'john smith')])
+        self.assertEqual(redacted, 'QQQQQQQQQQ was seen by QQQQQQQQQQ jr. and Mr QQQQQers.')
+
+    def test_overlapping_phrases(self):
+        self.assert_same(['aba', 'bab', 'ab'], 'abababab')
+        self.assert_same(['aa', 'aaa'], 'aaaaaaa')
+        self.assert_same(['Ann Lee', 'Lee Ann', 'Ann'], 'ann lee ann lee ann')
+        # the same phrase twice and a phrase inside another
+        self.assert_same(['Mary Jane', 'Jane', 'Mary Jane'], 'Mary Jane, MaryJane and Jane')
+
+    def test_phrases_with_the_replacement_char(self):
+        # later phrases can match text replaced by earlier ones
+        self.assert_same(['ab', 'QQc', 'q'], 'abc ab qq abc')
+        self.assert_same(['Quinn', 'qq', 'QQQQQ'], 'Quinn quinn')
+
+    def test_unicode_case_folding(self):
+        # the long s, the kelvin sign and the dotted/dotless i match s, k and i case insensitively
+        text = 'Ro\u017fs and \u212airk, ROSS and K\u0130RK, ro\u017f\u017f and k\u0131rk'
+        self.assert_same(['Ross', 'Kirk'], text)
+        self.assertEqual([p for p, v in single_scan(['Ross', 'Kirk'], text)[0]], [0, 15, 30, 9, 24, 39])
+        self.assert_same(['Strauß', 'ÉLISE'], 'STRAUß strauss élise Élise ÉLİSE')
+        self.assert_same(['ſam', 'İlk', 'ıla'], 'Sam sam ſam ilk İLK ıla ILA')
+
+    def test_escaped_word_boundaries(self):
+        # sensitive words are added as '\b' + word + '\b', which re.escape turns into literal backslashes
+        phrases = ['John Smith', '\\bJohn\\b', '\\bSmith\\b']
+        self.assert_same(phrases, 'John Smith and Johnny Smithers')
+        self.assert_same(phrases, 'a \\bjohn\\b and \\bSMITH\\b')
+        found, redacted = single_scan(phrases, 'a \\bjohn\\b here')
+        self.assertEqual(found, [(2, '\\bjohn\\b')])
+        self.assertEqual(redacted, 'a QQQQQQQQ here')
+
+    def test_empty(self):
+        self.assert_same([], 'some text')
+        self.assert_same(['x'], '')
+        self.assert_same(['', 'a'], 'banana')
+
+    def test_random(self):
+        rnd = random.Random(1)
+        for alphabet in ['aAbqQsS\u017fK\u212akI\u0130i\u0131 \\.x', 'abAB ', '\xe9\xc9\xdfs\u1e9e\u0130iIQ']:
+            for _ in range(2000):
+                text = ''.join(rnd.choice(alphabet) for _ in range(rnd.randint(0, 40)))
+                phrases = []
+                for _ in range(rnd.randint(0, 6)):
+                    if len(text) > 0 and rnd.random() < 0.6:
+                        i = rnd.randint(0, len(text) - 1)
+                        v = text[i:i + rnd.randint(1, 5)]
+                    else:
+                        v = ''.join(rnd.choice(alphabet) for _ in range(rnd.randint(1, 4)))
+                    if rnd.random() < 0.1:
+                        v = '\\b' + v + '\\b'
+                    phrases.append(v)
+                if len(phrases) > 0 and rnd.random() < 0.2:
+                    phrases.append(phrases[0])
+                self.assert_same(phrases, text)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+import random
+import unittest
+
+from SemEHR.rule_extractor import ExtractRule
+
+
+def one_by_one(text, replacements, replace_char='x'):
+    for pos, sent_text in replacements:
+        text = ExtractRule.do_replace(text, pos, sent_text, replace_char)
+    return text
+
+
+class ReplaceAllTest(unittest.TestCase):
+
+    def test_replace_all(self):
+        text = 'Mr John Smith, 12 Long Road, NW1 2AB'
+        replacements = [(3, 'John Smith'), (18, 'Long Road'), (29, 'NW1 2AB'), (8, 'Smith')]
+        self.assertEqual(ExtractRule.do_replace_all(text, replacements), 'Mr xxxx xxxxx, 12 xxxx xxxx, xxx xxx')
+        self.assertEqual(ExtractRule.do_replace_all(text, replacements), one_by_one(text, replacements))
+        self.assertEqual(ExtractRule.do_replace_all(text, []), text)
+
+    def test_overlapping_and_shifted_spans(self):
+        # a later replacement overwrites an earlier one, spans may hold text found elsewhere (e.g. numbers)
+        text = 'ab cd\tef\ngh'
+        for replacements in [[(0, 'ab cd'), (3, 'cd\tef')], [(1, 'b c'), (0, 'gh'), (1, 'b c')],
+                             [(6, 'ef\ngh'), (0, 'a  ')], [(4, 'ab')]]:
+            self.assertEqual(ExtractRule.do_replace_all(text, replacements, '*'),
+                             one_by_one(text, replacements, '*'))
+
+    def test_replace_char(self):
+        self.assertEqual(ExtractRule.do_replace_all('a b', [(0, 'a b')], '\\'), '\\ \\')
+        for replace_char in ['', 'xx']:
+            with self.assertRaises(Exception):
+                ExtractRule.do_replace_all('a b', [(0, 'a')], replace_char)
+
+    def test_random(self):
+        rnd = random.Random(2)
+        alphabet = 'ab \n\t  \v.'
+        for _ in range(5000):
+            text = ''.join(rnd.choice(alphabet) for _ in range(rnd.randint(1, 40)))
+            replacements = []
+            for _ in range(rnd.randint(0, 8)):
+                p = rnd.randint(0, len(text) - 1)
+                n = rnd.randint(0, len(text) - p)
+                q = p if rnd.random() < 0.7 else rnd.randint(0, len(text) - n)
+                replacements.append((p, text[q:q + n]))
+            if len(replacements) > 0 and rnd.random() < 0.3:
+                replacements.append(rnd.choice(replacements))
+            replace_char = rnd.choice(['x', '*', '\\'])
+            self.assertEqual(ExtractRule.do_replace_all(text, replacements, replace_char),
+                             one_by_one(text, replacements, replace_char))
+
+
+if __name__ == '__main__':
+    unittest.main()